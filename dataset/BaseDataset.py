@@ -1,7 +1,12 @@
 import numpy as np
+import os
 import random
+import cv2
 import torch
 import torch.utils.data as data
+from dataset.image_cache import ImageCache
+from utils.dist_util import is_main_process, synchronize
+from utils.target_util import assign_yolo_target
 
 class BaseDataset(data.Dataset):
     def __init__(self, cfg, subset, istrain):
@@ -15,56 +20,167 @@ class BaseDataset(data.Dataset):
         self.strides = np.array([8, 16, 32])
         self.numcls = cfg.MODEL.numcls
         self.labels = cfg.MODEL.LABEL
+        self.target_in_worker = cfg.DATASET.target_in_worker
+        self.image_cache_root = cfg.DATASET.image_cache
+        self.image_cache = None
+        self.uint8 = cfg.DATASET.uint8
+        self.mixup_pool = cfg.DATASET.mixup_pool
+        self.mixup_refresh = cfg.DATASET.mixup_refresh
+        # augmented (img,bboxes,labels) of this worker, every worker process holds its own copy
+        self._pool = []
 
     def __len__(self):
         raise NotImplementedError
 
+    def _read_sample(self, itemidx):
+        """
+        decode the image and parse its annotation from the raw dataset
+        :return: img,bboxes,labels,imgpath
+        """
+        raise NotImplementedError
+
+    def _source_files(self):
+        """
+        :return: the image and annotation files _read_sample reads, the image cache is rebuilt when one changes
+        """
+        raise NotImplementedError
+
+    def _load_sample(self, itemidx):
+        if self.image_cache is not None:
+            return self.image_cache[itemidx]
+        return self._read_sample(itemidx)
+
+    def _init_image_cache(self, name):
+        """
+        read the samples from DATASET.image_cache/name, the cache is built on the first run and rebuilt when the
+        split or any image or annotation file changes
+        """
+        if not self.image_cache_root:
+            return
+        cachedir = os.path.join(self.image_cache_root, name)
+        if is_main_process():
+            sources = self._source_files()
+            if not ImageCache.valid(cachedir, sources):
+                print("building image cache {}".format(cachedir))
+                ImageCache.build(cachedir, (self._read_sample(i) for i in range(len(self._ids))), sources)
+        synchronize()
+        self.image_cache = ImageCache(cachedir)
+        assert len(self.image_cache) == len(self._ids), "image cache {} is stale, remove it".format(cachedir)
+
     def _parse_annotation(self, itemidx, random_trainsize):
         raise NotImplementedError
 
-    def _load_batch(self, idx_batch, random_trainsize):
-        batch_image = []
-        batch_box = []
-        batch_mixweight = []
-        imgpath_batch = []
-        orishape_batch = []
-        for idx in range(self.batch_size):
-            idxitem = idx_batch * self.batch_size + idx
-            image_org, bboxes_org, labels_org, imgpath, ori_shape = self._parse_annotation(idxitem, random_trainsize)
-            if random.random() < 0.5 and self.istrain:
-                index_mix = random.randint(0, len(self._ids) - 1)
-                image_mix, bboxes_mix, label_mix, _, _ = self._parse_annotation(index_mix, random_trainsize)
-
-                lam = np.random.beta(1.5, 1.5)
-                img = lam * image_org + (1 - lam) * image_mix
-                mixw_org = torch.ones(bboxes_org.shape[0]) * lam
-                mixw_mix = torch.ones(bboxes_mix.shape[0]) * (1 - lam)
-                mix_weight = torch.cat([mixw_org, mixw_mix])
-                bboxes = np.concatenate([bboxes_org, bboxes_mix])
-                labels = np.concatenate([labels_org,label_mix])
+    def _mix_partner(self, random_trainsize):
+        """
+        :return: augmented img,bboxes,labels to mix with, resized to random_trainsize when it comes from the pool
+        """
+        if self.mixup_pool == 0 or not self._pool:
+            index_mix = random.randint(0, len(self._ids) - 1)
+            image_mix, bboxes_mix, label_mix, _, _ = self._parse_annotation(index_mix, random_trainsize)
+            return image_mix, bboxes_mix, label_mix
+        image_mix, bboxes_mix, label_mix = random.choice(self._pool)
+        size = image_mix.shape[0]
+        if size != random_trainsize:
+            # the letterboxed images are square, the boxes scale with the image
+            image_mix = cv2.resize(image_mix, (random_trainsize, random_trainsize))
+            bboxes_mix = bboxes_mix * (1.0 * random_trainsize / size)
+        return image_mix, bboxes_mix, label_mix
+
+    def _update_pool(self, image, bboxes, labels):
+        if len(self._pool) < self.mixup_pool:
+            self._pool.append((image, bboxes, labels))
+        elif random.random() < self.mixup_refresh:
+            self._pool[random.randrange(self.mixup_pool)] = (image, bboxes, labels)
+
+    def _load_sample_mix(self, itemidx, random_trainsize):
+        image_org, bboxes_org, labels_org, imgpath, ori_shape = self._parse_annotation(itemidx, random_trainsize)
+        if random.random() < 0.5 and self.istrain:
+            image_mix, bboxes_mix, label_mix = self._mix_partner(random_trainsize)
+
+            lam = np.random.beta(1.5, 1.5)
+            if self.uint8:
+                img = cv2.addWeighted(image_org, lam, image_mix, 1 - lam, 0)
             else:
-                img = image_org
-                bboxes = bboxes_org
-                labels=labels_org
-                mix_weight = torch.ones(bboxes_org.shape[0]).float()
-            batch_image.append(img)
-            batch_mixweight.append(mix_weight)
-            targets=np.concatenate([bboxes,labels[...,None],mix_weight[...,None]],1).astype(np.float32)
-            batch_box.append(torch.from_numpy(targets))
-            imgpath_batch.append(imgpath)
-            orishape_batch.append(ori_shape)
-        return torch.from_numpy(np.array(batch_image).transpose((0, 3, 1, 2)).astype(np.float32)), \
-               imgpath_batch, \
-               torch.from_numpy(np.array(orishape_batch).astype(np.float32)), \
-               batch_box
+                img = lam * image_org + (1 - lam) * image_mix
+            mixw_org = torch.ones(bboxes_org.shape[0]) * lam
+            mixw_mix = torch.ones(bboxes_mix.shape[0]) * (1 - lam)
+            mix_weight = torch.cat([mixw_org, mixw_mix])
+            bboxes = np.concatenate([bboxes_org, bboxes_mix])
+            labels = np.concatenate([labels_org,label_mix])
+        else:
+            img = image_org
+            bboxes = bboxes_org
+            labels=labels_org
+            mix_weight = torch.ones(bboxes_org.shape[0]).float()
+        if self.mixup_pool > 0 and self.istrain:
+            self._update_pool(image_org, bboxes_org, labels_org)
+        targets=np.concatenate([bboxes,labels[...,None],mix_weight[...,None]],1).astype(np.float32)
+        img = torch.from_numpy(np.ascontiguousarray(img.transpose((2, 0, 1)),
+                                                    dtype=np.uint8 if self.uint8 else np.float32))
+        return img, imgpath, ori_shape, torch.from_numpy(targets)
 
     def __getitem__(self, item):
-        if self.istrain:
+        """
+        :param item: index of the image, or (index,input size) from MultiScaleBatchSampler
+        """
+        if isinstance(item, (tuple, list)):
+            item, trainsize = item
+        elif self.istrain:
             trainsize = random.choice(self.trainsizes)
         else:
             trainsize = self.testsize
+        return self._load_sample_mix(item, trainsize)
+
+    def collate_fn(self, batch):
+        """
+        :return: img [bz,3,H,W], imgpath list, orishape [bz,2], gtbox list of [N,6]
+                and (anchor_idx,anchor_target) if DATASET.target_in_worker
+        """
+        batch_image, imgpath_batch, orishape_batch, batch_box = zip(*batch)
+        batch_image = torch.stack(batch_image, 0)
+        orishape_batch = torch.from_numpy(np.array(orishape_batch).astype(np.float32))
+        batch_box = list(batch_box)
+        imgpath_batch = list(imgpath_batch)
+        if self.target_in_worker and self.istrain:
+            # sparse targets, the model scatters them into a dense tensor
+            anchor_idx, anchor_target = assign_yolo_target(batch_box, batch_image.shape[-1], self.numcls,
+                                                           self._gt_per_grid, strides=tuple(self.strides.tolist()))
+            return batch_image, imgpath_batch, orishape_batch, batch_box, anchor_idx, anchor_target
+        return batch_image, imgpath_batch, orishape_batch, batch_box
+
+
+class MultiScaleBatchSampler(data.BatchSampler):
+    """
+    Batches of (index,input size), every image of a batch gets the same randomly picked size.
+    """
+
+    def __init__(self, sampler, batch_size, drop_last, sizes):
+        super().__init__(sampler, batch_size, drop_last)
+        self.sizes = sizes
+
+    def __iter__(self):
+        for batch in super().__iter__():
+            size = random.choice(self.sizes)
+            yield [(idx, size) for idx in batch]
+
 
-        return self._load_batch(item, trainsize)
+def get_dataloader(cfg, dataset, shuffle):
+    """
+    per-image dataset -> DataLoader of batches, the multi-scale size is picked per batch
+    """
+    if cfg.ngpu > 1:
+        sampler = data.DistributedSampler(dataset, shuffle=shuffle)
+    elif shuffle:
+        sampler = data.RandomSampler(dataset)
+    else:
+        sampler = data.SequentialSampler(dataset)
+    sizes = dataset.trainsizes if dataset.istrain else [dataset.testsize]
+    batch_sampler = MultiScaleBatchSampler(sampler, dataset.batch_size, drop_last=dataset.istrain, sizes=sizes)
+    kwargs = {}
+    if cfg.DATASET.numworker > 0:
+        kwargs.update(persistent_workers=cfg.DATASET.persistent_workers, prefetch_factor=cfg.DATASET.prefetch_factor)
+    return data.DataLoader(dataset=dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn,
+                           num_workers=cfg.DATASET.numworker, pin_memory=True, **kwargs)
 
 
 if __name__ == '__main__':
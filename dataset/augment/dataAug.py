@@ -82,4 +82,137 @@ def img_preprocess2(image, bboxes, target_shape, correct_box=True):
         bboxes[:, [0, 2]] = bboxes[:, [0, 2]] * resize_ratio + dw
         bboxes[:, [1, 3]] = bboxes[:, [1, 3]] * resize_ratio + dh
         return image, bboxes
-    return image
\ No newline at end of file
+    return image
+
+def random_geometry(img_shape, bboxes, p=0.5):
+    """
+    Draw the same random flip -> crop -> translate as random_horizontal_flip, random_crop and random_translate,
+    without touching the image.
+    :param img_shape: shape of the original image
+    :return: 3x3 affine matrix from the original image to the augmented one(in pixel edge coordinates),
+            (h, w) of the augmented image, (xmin, ymin, xmax, ymax) window of the original image kept by the crop
+    """
+    h_img, w_img = img_shape[:2]
+    flip = False
+    window = [0, 0, w_img, h_img]
+    M = np.eye(3)
+    bboxes = np.array(bboxes, dtype=np.float64)
+    if random.random() < p:
+        flip = True
+        M = np.array([[-1, 0, w_img], [0, 1, 0], [0, 0, 1]]) @ M
+        bboxes[:, [0, 2]] = w_img - bboxes[:, [2, 0]]
+    if random.random() < p:
+        max_bbox = np.concatenate([np.min(bboxes[:, 0:2], axis=0), np.max(bboxes[:, 2:4], axis=0)], axis=-1)
+        crop_xmin = max(0, int(max_bbox[0] - random.uniform(0, max_bbox[0])))
+        crop_ymin = max(0, int(max_bbox[1] - random.uniform(0, max_bbox[1])))
+        crop_xmax = max(w_img, int(max_bbox[2] + random.uniform(0, w_img - max_bbox[2])))
+        crop_ymax = max(h_img, int(max_bbox[3] + random.uniform(0, h_img - max_bbox[3])))
+        M = np.array([[1, 0, -crop_xmin], [0, 1, -crop_ymin], [0, 0, 1]]) @ M
+        bboxes[:, [0, 2]] -= crop_xmin
+        bboxes[:, [1, 3]] -= crop_ymin
+        # the slice of random_crop stops at the image border
+        crop_xmax, crop_ymax = min(crop_xmax, w_img), min(crop_ymax, h_img)
+        if flip:
+            window = [w_img - crop_xmax, crop_ymin, w_img - crop_xmin, crop_ymax]
+        else:
+            window = [crop_xmin, crop_ymin, crop_xmax, crop_ymax]
+        w_img = crop_xmax - crop_xmin
+        h_img = crop_ymax - crop_ymin
+    if random.random() < p:
+        max_bbox = np.concatenate([np.min(bboxes[:, 0:2], axis=0), np.max(bboxes[:, 2:4], axis=0)], axis=-1)
+        tx = random.uniform(-(max_bbox[0] - 1), (w_img - max_bbox[2] - 1))
+        ty = random.uniform(-(max_bbox[1] - 1), (h_img - max_bbox[3] - 1))
+        M = np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]]) @ M
+    return M, (h_img, w_img), window
+
+
+def affine_preprocess(image, bboxes, target_shape, augment=True, p=0.5, uint8=False):
+    """
+    random flip/crop/translate(see random_geometry) and img_preprocess2 composed into one affine matrix,
+    the original BGR image is warped once straight to the letterboxed target.
+    :param target_shape: (h, w) of the output
+    :param uint8: return the RGB image as uint8 in [0,255], the model does the scaling(see InputNorm)
+    :return: RGB float32 image in [0,1] of target_shape, bboxes in the output image, (h, w) before the letterbox
+    """
+    h_target, w_target = target_shape
+    if augment:
+        M, (h_img, w_img), (xmin, ymin, xmax, ymax) = random_geometry(image.shape, bboxes, p)
+        # warp from the crop window(a view), what the crop removed stays black when the translation uncovers it
+        image = image[ymin:ymax, xmin:xmax]
+        Mimg = M @ np.array([[1, 0, xmin], [0, 1, ymin], [0, 0, 1]])
+    else:
+        M, (h_img, w_img) = np.eye(3), image.shape[:2]
+        Mimg = M
+    resize_ratio = min(1.0 * w_target / w_img, 1.0 * h_target / h_img)
+    resize_w = int(resize_ratio * w_img)
+    resize_h = int(resize_ratio * h_img)
+    dw = int((w_target - resize_w) / 2)
+    dh = int((h_target - resize_h) / 2)
+    letterbox = np.array([[resize_w / w_img, 0, dw], [0, resize_h / h_img, dh], [0, 0, 1]])
+    M = letterbox @ M
+
+    # cv2 maps pixel centers, M maps pixel edges
+    center = np.array([[1, 0, 0.5], [0, 1, 0.5], [0, 0, 1]])
+    warp = (np.linalg.inv(center) @ letterbox @ Mimg @ center)[:2]
+    # the area uncovered by the translation is black, the letterbox padding is gray
+    out = cv2.warpAffine(image, warp, (w_target, h_target), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT,
+                         borderValue=(0, 0, 0))
+    out[:dh] = 128
+    out[dh + resize_h:] = 128
+    out[:, :dw] = 128
+    out[:, dw + resize_w:] = 128
+    out = cv2.cvtColor(out, cv2.COLOR_BGR2RGB)
+    if not uint8:
+        out = out.astype(np.float32)
+        out *= 1.0 / 255
+
+    bboxes = np.array(bboxes, dtype=np.float64)
+    if len(bboxes):
+        corners = np.stack([bboxes[:, [0, 1]], bboxes[:, [2, 1]], bboxes[:, [0, 3]], bboxes[:, [2, 3]]], 1)
+        corners = corners @ M[:2, :2].T + M[:2, 2]
+        bboxes = np.concatenate([corners.min(1), corners.max(1)], -1)
+    return out, bboxes, (h_img, w_img)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="samples/sec of the chained and the fused augmentation")
+    parser.add_argument("--image", default=None, help="image to augment, a random 500x375 one by default")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--iters", type=int, default=200)
+    args = parser.parse_args()
+    if args.image is not None:
+        img = cv2.imread(args.image, cv2.IMREAD_COLOR)
+    else:
+        img = cv2.resize(np.random.randint(0, 256, (24, 32, 3), dtype=np.uint8), (500, 375))
+    h, w = img.shape[:2]
+    bboxes = np.array([[w * 0.2, h * 0.3, w * 0.6, h * 0.8], [w * 0.5, h * 0.1, w * 0.9, h * 0.5]])
+
+    def chained(img, bboxes):
+        img, bboxes = random_horizontal_flip(np.copy(img), np.copy(bboxes))
+        img, bboxes = random_crop(np.copy(img), np.copy(bboxes))
+        img, bboxes = random_translate(np.copy(img), np.copy(bboxes))
+        ori_shape = img.shape[:2]
+        img, bboxes = img_preprocess2(np.copy(img), np.copy(bboxes), (args.size, args.size), True)
+        return img, bboxes, ori_shape
+
+    def fused(img, bboxes):
+        return affine_preprocess(img, bboxes, (args.size, args.size), True)
+
+    # same random draws, so the outputs are comparable, seed 7 crops and translates
+    for i in list(range(5)) + [7]:
+        random.seed(i)
+        img0, box0, shape0 = chained(img, bboxes)
+        random.seed(i)
+        img1, box1, shape1 = fused(img, bboxes)
+        assert shape0 == shape1
+        assert np.abs(img0 - img1).mean() < 0.01, i
+        print("seed {}: max box diff {:.3f}px, mean pixel diff {:.4f}".format(
+            i, np.abs(box0 - box1).max(), np.abs(img0 - img1).mean()))
+    for name, fn in (('chained', chained), ('fused', fused)):
+        start = time.time()
+        for _ in range(args.iters):
+            fn(img, bboxes)
+        print("{}: {:.1f} samples/sec".format(name, args.iters / (time.time() - start)))
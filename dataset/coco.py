@@ -8,13 +8,14 @@ import random
 import torch.utils.data as data
 import torch
 import dataset.augment.dataAug  as dataAug
-from dataset.BaseDataset import BaseDataset
+from dataset.BaseDataset import BaseDataset, get_dataloader
 
 class COCOdataset(BaseDataset):
     def __init__(self, cfg,subset,istrain):
         super().__init__(cfg,subset,istrain)
         self.image_dir = "{}/images/{}2017".format(self.dataset_root, subset)
-        self.coco = COCO("{}/annotations/instances_{}2017.json".format(self.dataset_root, subset))
+        self.annfile = "{}/annotations/instances_{}2017.json".format(self.dataset_root, subset)
+        self.coco = COCO(self.annfile)
         # get the mapping from original category ids to labels
         self.cat_ids = self.coco.getCatIds()
         self.numcls = len(self.cat_ids)
@@ -23,6 +24,7 @@ class COCOdataset(BaseDataset):
             for i, cat_id in enumerate(self.cat_ids)
         }
         self._ids, self.img_infos = self._filter_imgs()
+        self._init_image_cache('COCO_' + subset)
 
     def _filter_imgs(self, min_size=32):
         # Filter images without ground truths.
@@ -81,9 +83,12 @@ class COCOdataset(BaseDataset):
         return ann
 
     def __len__(self):
-        return len(self._ids) // self.batch_size
+        return len(self._ids)
 
-    def _parse_annotation(self,itemidx,random_trainsize):
+    def _source_files(self):
+        return [osp.join(self.image_dir, info['file_name']) for info in self.img_infos] + [self.annfile]
+
+    def _read_sample(self, itemidx):
         img_info = self.img_infos[itemidx]
         ann_info = self._load_ann_info(itemidx)
         ann = self._parse_ann_info(ann_info)
@@ -92,23 +97,23 @@ class COCOdataset(BaseDataset):
         # load the image.
         imgpath=osp.join(self.image_dir, img_info['file_name'])
         img = cv2.imread(imgpath, cv2.IMREAD_COLOR)
-        if self.istrain:
-            img, bboxes = dataAug.random_horizontal_flip(np.copy(img), np.copy(bboxes))
-            img, bboxes = dataAug.random_crop(np.copy(img), np.copy(bboxes))
-            img, bboxes = dataAug.random_translate(np.copy(img), np.copy(bboxes))
-        ori_shape=img.shape[:2]
-        img, bboxes = dataAug.img_preprocess2(np.copy(img), np.copy(bboxes),
-                                              (random_trainsize, random_trainsize), True)
+        return img, bboxes, labels, imgpath
+
+    def _parse_annotation(self,itemidx,random_trainsize):
+        img, bboxes, labels, imgpath = self._load_sample(itemidx)
+        # flip/crop/translate and the letterbox in a single warp
+        img, bboxes, ori_shape = dataAug.affine_preprocess(img, bboxes, (random_trainsize, random_trainsize),
+                                                           augment=self.istrain, uint8=self.uint8)
         return img,bboxes,labels,imgpath,ori_shape
 
 
 def get_dataset(cfg):
     valset = COCOdataset(cfg, subset='val',istrain=False)
-    valset = torch.utils.data.DataLoader(dataset=valset, batch_size=1, shuffle=True, num_workers=cfg.DATASET.numworker, pin_memory=True)
+    valset = get_dataloader(cfg, valset, shuffle=True)
     if cfg.debug:
         return valset, valset
     trainset = COCOdataset(cfg, subset='train',istrain=True)
-    trainset = torch.utils.data.DataLoader(dataset=trainset, batch_size=1, shuffle=True, num_workers=cfg.DATASET.numworker, pin_memory=True)
+    trainset = get_dataloader(cfg, trainset, shuffle=True)
     return trainset, valset
 
 
@@ -1,5 +1,5 @@
 import numpy as np
-from utils.dataset_util import PascalVocXmlParser
+from utils.dataset_util import AnnotationIndex, get_index_path
 import cv2
 from dataset.augment import transform
 import os
@@ -9,7 +9,7 @@ from torch.utils.data import DataLoader
 import os.path as osp
 import dataset.augment.dataAug  as dataAug
 import xml.etree.ElementTree as ET
-from dataset.BaseDataset import BaseDataset
+from dataset.BaseDataset import BaseDataset, get_dataloader
 from utils.dist_util import *
 class Customdataset(BaseDataset):
     def __init__(self,cfg, istrain):
@@ -24,37 +24,35 @@ class Customdataset(BaseDataset):
         else:
             for line in open(os.path.join(rootpath, 'val.txt')):
                 self._ids.append((rootpath, line.strip()))
+        name = 'Custom_' + ('train' if istrain else 'val')
+        self.annotations = AnnotationIndex([self._annopath.format(*item) for item in self._ids], self.labels,
+                                           get_index_path(cfg.DATASET.anno_index, name))
+        self._init_image_cache(name)
+
     def __len__(self):
-        return len(self._ids) // self.batch_size
-    def _parse_annotation(self,itemidx,random_trainsize):
+        return len(self._ids)
+    def _source_files(self):
+        return [self._imgpath.format(*item) for item in self._ids] + self.annotations.annfiles
+    def _read_sample(self, itemidx):
         rootpath, filename = self._ids[itemidx]
-        annpath = self._annopath.format(rootpath, filename)
         imgpath = self._imgpath.format(rootpath, filename)
-        fname, bboxes, labels = PascalVocXmlParser(annpath, self.labels).parse()
+        bboxes, labels = self.annotations.get(itemidx)
         img = cv2.imread(imgpath, cv2.IMREAD_COLOR)
-        if self.istrain:
-            img, bboxes = dataAug.random_horizontal_flip(np.copy(img), np.copy(bboxes))
-            img, bboxes = dataAug.random_crop(np.copy(img), np.copy(bboxes))
-            img, bboxes = dataAug.random_translate(np.copy(img), np.copy(bboxes))
-        ori_shape=img.shape[:2]
-        img, bboxes = dataAug.img_preprocess2(np.copy(img), np.copy(bboxes),
-                                              (random_trainsize, random_trainsize), True)
+        return img, bboxes, labels, imgpath
+
+    def _parse_annotation(self,itemidx,random_trainsize):
+        img, bboxes, labels, imgpath = self._load_sample(itemidx)
+        # flip/crop/translate and the letterbox in a single warp
+        img, bboxes, ori_shape = dataAug.affine_preprocess(img, bboxes, (random_trainsize, random_trainsize),
+                                                           augment=self.istrain, uint8=self.uint8)
         return img,bboxes,labels,imgpath,ori_shape
 
 def get_dataset(cfg):
     trainset = Customdataset(cfg,istrain=True)
-    if cfg.ngpu>1:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(trainset)
-        trainloader = DataLoader(sampler=train_sampler,dataset=trainset, batch_size=1, shuffle=False, num_workers=cfg.DATASET.numworker, pin_memory=True)
-    else:
-        trainloader = DataLoader(dataset=trainset, batch_size=1, shuffle=True, num_workers=cfg.DATASET.numworker, pin_memory=True)
+    trainloader = get_dataloader(cfg, trainset, shuffle=True)
 
     valset = Customdataset(cfg,istrain=False)
-    if cfg.ngpu>1:
-        val_sampler = torch.utils.data.distributed.DistributedSampler(valset)
-        valloader = DataLoader(sampler=val_sampler,dataset=valset, batch_size=1, shuffle=False, num_workers=cfg.DATASET.numworker, pin_memory=True)
-    else:
-        valloader = DataLoader(dataset=valset, batch_size=1, shuffle=False, num_workers=cfg.DATASET.numworker, pin_memory=True)
+    valloader = get_dataloader(cfg, valset, shuffle=False)
     return trainloader, valloader
 
 
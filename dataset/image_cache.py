@@ -0,0 +1,117 @@
+import os
+import numpy as np
+
+
+class ImageCache(object):
+    """
+    Decoded uint8 images stored back to back in memory-mapped shard files, with the boxes and labels of each image.
+    Layout of a cache dir:
+        shard_{k}.bin   raw HWC bgr pixels
+        index.npz       shard/offset/shape of each image, boxes and labels concatenated with per-image offsets,
+                        the source files(images and annotations) and their mtimes
+    The shards are opened lazily in each process, so the cache can be handed to DataLoader workers.
+    """
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        index = np.load(os.path.join(cachedir, 'index.npz'))
+        self.shard = index['shard']
+        self.offset = index['offset']
+        self.shape = index['shape']
+        self.box_offset = index['box_offset']
+        self.boxes = index['boxes']
+        self.labels = index['labels']
+        self.imgpaths = index['imgpaths']
+        self._shards = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self.shard)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def _open_shards(self):
+        # memmaps are not shared across processes, every worker maps the shards itself
+        if self._shards is None or self._pid != os.getpid():
+            self._shards = [np.memmap(os.path.join(self.cachedir, 'shard_{}.bin'.format(i)), dtype=np.uint8, mode='r')
+                            for i in range(int(self.shard.max()) + 1)]
+            self._pid = os.getpid()
+        return self._shards
+
+    def __getitem__(self, idx):
+        """
+        :return: img(read-only view of the shard, [H,W,3] uint8), bboxes [N,4], labels [N], imgpath
+        """
+        shards = self._open_shards()
+        h, w, c = self.shape[idx]
+        start = self.offset[idx]
+        img = shards[self.shard[idx]][start:start + h * w * c].reshape(h, w, c)
+        boxes = self.boxes[self.box_offset[idx]:self.box_offset[idx + 1]]
+        labels = self.labels[self.box_offset[idx]:self.box_offset[idx + 1]]
+        return img, boxes, labels, str(self.imgpaths[idx])
+
+    @staticmethod
+    def exists(cachedir):
+        return os.path.exists(os.path.join(cachedir, 'index.npz'))
+
+    @staticmethod
+    def source_mtimes(sources):
+        return np.array([os.stat(f).st_mtime for f in sources], dtype=np.float64)
+
+    @staticmethod
+    def valid(cachedir, sources):
+        """
+        :param sources: files the samples are read from, the cache is stale once any of them changes
+        """
+        if not ImageCache.exists(cachedir):
+            return False
+        index = np.load(os.path.join(cachedir, 'index.npz'))
+        # caches of older versions have no sources and are rebuilt
+        return 'sources' in index and index['sources'].tolist() == list(sources) \
+               and np.array_equal(index['mtimes'], ImageCache.source_mtimes(sources))
+
+    @staticmethod
+    def build(cachedir, samples, sources=(), shard_bytes=4 << 30):
+        """
+        :param samples: iterable of (img,bboxes,labels,imgpath), img is the decoded uint8 image
+        :param sources: files the samples are read from, see valid
+        :param shard_bytes: start a new shard file once the current one exceeds it
+        """
+        sources = list(sources)
+        # taken before reading, a file changed during the build makes the cache stale
+        mtimes = ImageCache.source_mtimes(sources)
+        os.makedirs(cachedir, exist_ok=True)
+        shard, offset, shape, box_offset, boxes, labels, imgpaths = [], [], [], [0], [], [], []
+        shardidx, shardsize = 0, 0
+        f = open(os.path.join(cachedir, 'shard_0.bin'), 'wb')
+        for img, bbox, label, imgpath in samples:
+            img = np.ascontiguousarray(img, dtype=np.uint8)
+            if shardsize > 0 and shardsize + img.nbytes > shard_bytes:
+                f.close()
+                shardidx, shardsize = shardidx + 1, 0
+                f = open(os.path.join(cachedir, 'shard_{}.bin'.format(shardidx)), 'wb')
+            f.write(img.tobytes())
+            shard.append(shardidx)
+            offset.append(shardsize)
+            shape.append(img.shape)
+            shardsize += img.nbytes
+            boxes.append(np.asarray(bbox, dtype=np.float32).reshape(-1, 4))
+            labels.append(np.asarray(label, dtype=np.int32).reshape(-1))
+            box_offset.append(box_offset[-1] + len(labels[-1]))
+            imgpaths.append(imgpath)
+        f.close()
+        # write the index last, a cache without index.npz is incomplete and gets rebuilt
+        tmppath = os.path.join(cachedir, 'index.tmp.npz')
+        np.savez(tmppath,
+                 shard=np.array(shard, dtype=np.int32),
+                 offset=np.array(offset, dtype=np.int64),
+                 shape=np.array(shape, dtype=np.int32).reshape(-1, 3),
+                 box_offset=np.array(box_offset, dtype=np.int64),
+                 boxes=np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.float32),
+                 labels=np.concatenate(labels) if labels else np.zeros((0,), dtype=np.int32),
+                 imgpaths=np.array(imgpaths),
+                 sources=np.array(sources, dtype=str),
+                 mtimes=mtimes)
+        os.replace(tmppath, os.path.join(cachedir, 'index.npz'))
@@ -4,6 +4,7 @@ from utils.visualize import visualize_boxes
 import numpy as np
 import matplotlib.pyplot as plt
 from PIL import Image
+from utils.dist_util import all_gather
 
 class Evaluator:
   def __init__(self,anchors,cateNames,rootpath,score_thres=0.01,iou_thres=0.5):
@@ -23,6 +24,21 @@ class Evaluator:
   def append(self,grids,imgpath,padscale,orishape,inputsize):
     raise NotImplementedError
 
+  def update(self, imgpaths, nms_results):
+    """
+    :param nms_results: [(boxes,scores,labels)] output of torch_nms_batched for each image
+    """
+    for imgpath, (nms_boxes, nms_scores, nms_labels) in zip(imgpaths, nms_results):
+      if nms_boxes is not None:
+        self.append(imgpath, nms_boxes.cpu().numpy(), nms_scores.cpu().numpy(), nms_labels.cpu().numpy())
+
+  def merge(self):
+    """
+    collect the results of all ranks before evaluate
+    """
+    results = all_gather(self.rec_pred)
+    self.rec_pred = [rec for result in results for rec in result]
+
   def build_GT(self):
     raise NotImplementedError
 
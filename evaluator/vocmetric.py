@@ -0,0 +1,341 @@
+import numpy as np
+import torch
+from utils.dist_util import get_rank, get_world_size, all_gather_tensor
+
+
+def voc_ap(rec, prec, use_07_metric=False):
+    """ ap = voc_ap(rec, prec, [use_07_metric])
+    Compute VOC AP given precision and recall.
+    If use_07_metric is true, uses the
+    VOC 07 11 point method (default:True).
+    """
+    if use_07_metric:
+        # 11 point metric
+        ap = 0.
+        for t in np.arange(0., 1.1, 0.1):
+            if np.sum(rec >= t) == 0:
+                p = 0
+            else:
+                p = np.max(prec[rec >= t])
+            ap = ap + p / 11.
+    else:
+        # correct AP calculation
+        # first append sentinel values at the end
+        mrec = np.concatenate(([0.], rec, [1.]))
+        mpre = np.concatenate(([0.], prec, [0.]))
+
+        # compute the precision envelope
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
+
+        # to calculate area under PR curve, look for points
+        # where X axis (recall) changes value
+        i = np.where(mrec[1:] != mrec[:-1])[0]
+
+        # and sum (\Delta recall) * prec
+        ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
+    return ap
+
+
+def match_detections(pred_img, pred_boxes, gt_img, gt_boxes, gt_difficult, numimg, iou_thres):
+    """
+    Greedy VOC matching of the detections of one class, sorted by descending score.
+    Each detection takes the gt with the max iou in its image, the first detection on a gt is a tp,
+    detections on difficult gts are ignored.
+    :param pred_img: [P] image index of each detection, -1 for images without gt
+    :param gt_img: [G] image index of each gt, sorted
+    :param numimg: number of images
+    :return: tp [P], fp [P]
+    """
+    tp = np.zeros(len(pred_img))
+    fp = np.zeros(len(pred_img))
+    gt_start = np.searchsorted(gt_img, np.arange(numimg))
+    gt_count = np.bincount(gt_img, minlength=numimg)[:numimg]
+    counts = np.where(pred_img >= 0, gt_count[pred_img], 0)
+    has_gt = counts > 0
+    fp[~has_gt] = 1.
+    if not has_gt.any():
+        return tp, fp
+    # one row per (detection,gt of the same image) pair
+    pred_idx = np.nonzero(has_gt)[0]
+    counts = counts[has_gt]
+    seg_start = np.cumsum(counts) - counts
+    pair_pred = np.repeat(pred_idx, counts)
+    pair_gt = np.repeat(gt_start[pred_img[pred_idx]], counts) + np.arange(counts.sum()) - np.repeat(seg_start, counts)
+    _bbGT = gt_boxes[pair_gt]
+    _bbPre = pred_boxes[pair_pred]
+    ixmin = np.maximum(_bbGT[:, 0], _bbPre[:, 0])
+    iymin = np.maximum(_bbGT[:, 1], _bbPre[:, 1])
+    ixmax = np.minimum(_bbGT[:, 2], _bbPre[:, 2])
+    iymax = np.minimum(_bbGT[:, 3], _bbPre[:, 3])
+    iw = np.maximum(ixmax - ixmin, 0.)
+    ih = np.maximum(iymax - iymin, 0.)
+    inters = iw * ih
+    uni = ((_bbPre[:, 2] - _bbPre[:, 0]) * (_bbPre[:, 3] - _bbPre[:, 1]) +
+           (_bbGT[:, 2] - _bbGT[:, 0]) *
+           (_bbGT[:, 3] - _bbGT[:, 1]) - inters)
+    overlaps = inters / uni
+    ovmax = np.maximum.reduceat(overlaps, seg_start)
+    # first gt holding the max iou, like np.argmax
+    ismax = overlaps == np.repeat(ovmax, counts)
+    jmax = np.minimum.reduceat(np.where(ismax, pair_gt, len(gt_img)), seg_start)
+    matched = ovmax > iou_thres
+    fp[pred_idx[~matched]] = 1.
+    pred_idx, jmax = pred_idx[matched], jmax[matched]
+    notdiff = ~gt_difficult[jmax]
+    pred_idx, jmax = pred_idx[notdiff], jmax[notdiff]
+    # detections are sorted, the first one on each gt is the true positive
+    _, first = np.unique(jmax, return_index=True)
+    isfirst = np.zeros(len(jmax), dtype=np.bool_)
+    isfirst[first] = True
+    tp[pred_idx[isfirst]] = 1.
+    fp[pred_idx[~isfirst]] = 1.
+    return tp, fp
+
+
+def eval_class(pred_img, pred_boxes, pred_scores, gt_img, gt_boxes, gt_difficult, numimg, iou_thres,
+               use_07_metric=False):
+    """
+    :param pred_img,pred_boxes,pred_scores: detections of one class in append order
+    :param gt_img,gt_boxes,gt_difficult: gts of the same class sorted by image
+    :return: ap of the class, -1 if there is no detection
+    """
+    if len(pred_scores) == 0:
+        return -1.
+    sorted_ind = np.argsort(-pred_scores)
+    pred_img = pred_img[sorted_ind]
+    pred_boxes = pred_boxes[sorted_ind]
+    # only the images with detections count their positives
+    hasdet = np.zeros(numimg + 1, dtype=np.bool_)
+    hasdet[pred_img] = True
+    num_positives = np.sum(~gt_difficult & hasdet[gt_img])
+    tp, fp = match_detections(pred_img, pred_boxes, gt_img, gt_boxes, gt_difficult, numimg, iou_thres)
+    # compute precision recall
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(num_positives)
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    return voc_ap(rec, prec, use_07_metric)
+
+
+def evaluate_voc(pred_img, pred_boxes, pred_scores, pred_labels, gt_img, gt_boxes, gt_labels, gt_difficult,
+                 numimg, numcls, iou_thres, use_07_metric=False):
+    """
+    :return: [mAP]+[ap of each class]
+    """
+    aps = []
+    for cls in range(numcls):
+        predmask = pred_labels == cls
+        gtmask = gt_labels == cls
+        aps.append(eval_class(pred_img[predmask], pred_boxes[predmask], pred_scores[predmask],
+                              gt_img[gtmask], gt_boxes[gtmask], gt_difficult[gtmask], numimg, iou_thres,
+                              use_07_metric))
+    return [np.mean(aps)] + aps
+
+
+
+class VOCAccumulator(object):
+    """
+    Streaming VOC mAP: every image is matched against its gts when its detections arrive,
+    only the score, match result and label of each detection are kept.
+    Detections with equal scores may be ranked in another order than evaluate_voc, otherwise the APs are the same.
+    """
+
+    def __init__(self, gt_img, gt_boxes, gt_labels, gt_difficult, numimg, numcls, iou_thres, use_07_metric=False):
+        """
+        :param gt_img: [G] image index of each gt, sorted
+        """
+        self.numcls = numcls
+        self.iou_thres = iou_thres
+        self.use_07_metric = use_07_metric
+        # gts of each image sorted by class, so one match_detections call handles all classes of an image
+        order = np.lexsort((gt_labels, gt_img))
+        self.gt_boxes = gt_boxes[order]
+        self.gt_labels = gt_labels[order]
+        self.gt_difficult = gt_difficult[order]
+        self.gt_offsets = np.concatenate([[0], np.cumsum(np.bincount(gt_img, minlength=numimg)[:numimg])])
+        # non-difficult gts of each image*numcls+class, an image counts the positives of the classes it has
+        # detections of
+        keys = gt_img[order].astype(np.int64) * numcls + self.gt_labels
+        self.pos_keys, self.pos_counts = np.unique(keys[~self.gt_difficult], return_counts=True)
+        self.reset()
+
+    def reset(self):
+        # score, match(1 tp, 0 fp, -1 ignored by a difficult gt), label and image of every detection
+        self.scores, self.matches, self.labels, self.imgs = [], [], [], []
+        self.seen = set()
+
+    def update(self, img, boxes, scores, labels):
+        """
+        :param img: image index of the detections, -1 for images without gt
+        :param boxes: [N,4] scores [N] labels [N] detections of one image after nms
+        """
+        if img >= 0:
+            # DistributedSampler pads the ranks with repeated images, each image counts once
+            if img in self.seen:
+                return
+            self.seen.add(img)
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        if img >= 0:
+            start, end = self.gt_offsets[img], self.gt_offsets[img + 1]
+        else:
+            start, end = 0, 0
+        gt_boxes, gt_labels, gt_difficult = self.gt_boxes[start:end], self.gt_labels[start:end], \
+                                            self.gt_difficult[start:end]
+        # the classes act as images of match_detections
+        sorted_ind = np.argsort(-scores)
+        tp, fp = match_detections(labels[sorted_ind], boxes[sorted_ind], gt_labels, gt_boxes, gt_difficult,
+                                  self.numcls, self.iou_thres)
+        self.scores.append(scores[sorted_ind])
+        self.matches.append((tp - (1 - tp - fp)).astype(np.int8))
+        self.labels.append(labels[sorted_ind].astype(np.int32))
+        self.imgs.append(np.full(len(scores), img, dtype=np.int32))
+
+    def _state(self):
+        if len(self.scores) == 0:
+            return np.zeros(0), np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        return np.concatenate(self.scores), np.concatenate(self.matches), np.concatenate(self.labels), \
+               np.concatenate(self.imgs)
+
+    def _num_positives(self, labels, imgs):
+        """
+        :return: [numcls] non-difficult gts of the classes each image has detections of
+        """
+        keys = np.unique(imgs[imgs >= 0].astype(np.int64) * self.numcls + labels[imgs >= 0])
+        if len(self.pos_keys) == 0:
+            return np.zeros(self.numcls)
+        idx = np.minimum(np.searchsorted(self.pos_keys, keys), len(self.pos_keys) - 1)
+        found = self.pos_keys[idx] == keys
+        return np.bincount(keys[found] % self.numcls, weights=self.pos_counts[idx[found]], minlength=self.numcls)
+
+    def merge(self):
+        """
+        gather the detections of all ranks with tensor collectives, every rank gets the whole state
+        """
+        if get_world_size() == 1:
+            return
+        state = self._state()
+        ranks = np.full(len(state[0]), get_rank(), dtype=np.int32)
+        scores, matches, labels, imgs, ranks = [all_gather_tensor(torch.from_numpy(x)).numpy()
+                                                for x in state + (ranks,)]
+        # an image padded in by DistributedSampler is on two ranks, keep the detections of the first one
+        uimgs, first = np.unique(imgs, return_index=True)
+        keep = (imgs < 0) | (ranks == ranks[first][np.searchsorted(uimgs, imgs)])
+        self.reset()
+        self.scores, self.matches, self.labels, self.imgs = [scores[keep]], [matches[keep]], [labels[keep]], \
+                                                            [imgs[keep]]
+
+    def evaluate(self):
+        """
+        :return: [mAP]+[ap of each class], -1 for classes without detection
+        """
+        scores, matches, labels, imgs = self._state()
+        num_positives = self._num_positives(labels, imgs)
+        aps = []
+        for cls in range(self.numcls):
+            clsmask = labels == cls
+            if not clsmask.any():
+                aps.append(-1.)
+                continue
+            sorted_ind = np.argsort(-scores[clsmask])
+            match = matches[clsmask][sorted_ind]
+            # compute precision recall
+            fp = np.cumsum((match == 0).astype(np.float64))
+            tp = np.cumsum((match == 1).astype(np.float64))
+            rec = tp / float(num_positives[cls])
+            prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+            aps.append(voc_ap(rec, prec, self.use_07_metric))
+        return [np.mean(aps)] + aps
+
+if __name__ == '__main__':
+    import time
+    from collections import defaultdict
+
+    def evaluate_loop(rec_pred, rec_gt, numcls, iou_thres):
+        # the per-detection loop evaluate_voc replaces, kept as reference
+        aps = []
+        for cls in range(numcls):
+            _recs_pre = rec_pred[cls]
+            if len(_recs_pre) == 0:
+                aps.append(-1.)
+                continue
+            scores = np.array([rec['score'] for rec in _recs_pre])
+            sorted_ind = np.argsort(-scores)
+            bboxs = np.array([rec['bbox'] for rec in _recs_pre])[sorted_ind]
+            img_idxs = [_recs_pre[idx]['img_idx'] for idx in sorted_ind]
+            num_positives = 0
+            tp = np.zeros(len(img_idxs))
+            fp = np.zeros(len(img_idxs))
+            _recs_gt = defaultdict(dict)
+            for imgidx in set(img_idxs):
+                _rec = [rec for rec in rec_gt[imgidx] if rec['label'] == cls]
+                _dif = np.array([rec['difficult'] for rec in _rec]).astype(np.bool_)
+                num_positives += sum(~_dif)
+                _recs_gt[imgidx] = {'bbox': np.array([rec['bbox'] for rec in _rec]), 'difficult': _dif,
+                                    'detected': [False] * len(_rec)}
+            for idx in range(len(img_idxs)):
+                _rec_gt = _recs_gt[img_idxs[idx]]
+                _bbGT = _rec_gt['bbox']
+                _bbPre = bboxs[idx, :]
+                ovmax = -np.inf
+                if _bbGT.size > 0:
+                    ixmin = np.maximum(_bbGT[:, 0], _bbPre[0])
+                    iymin = np.maximum(_bbGT[:, 1], _bbPre[1])
+                    ixmax = np.minimum(_bbGT[:, 2], _bbPre[2])
+                    iymax = np.minimum(_bbGT[:, 3], _bbPre[3])
+                    iw = np.maximum(ixmax - ixmin, 0.)
+                    ih = np.maximum(iymax - iymin, 0.)
+                    inters = iw * ih
+                    uni = ((_bbPre[2] - _bbPre[0]) * (_bbPre[3] - _bbPre[1]) +
+                           (_bbGT[:, 2] - _bbGT[:, 0]) *
+                           (_bbGT[:, 3] - _bbGT[:, 1]) - inters)
+                    overlaps = inters / uni
+                    ovmax = np.max(overlaps)
+                    jmax = np.argmax(overlaps)
+                if ovmax > iou_thres:
+                    if not _rec_gt['difficult'][jmax]:
+                        if not _rec_gt['detected'][jmax]:
+                            tp[idx] = 1.
+                            _rec_gt['detected'][jmax] = 1
+                        else:
+                            fp[idx] = 1.
+                else:
+                    fp[idx] = 1.
+            fp = np.cumsum(fp)
+            tp = np.cumsum(tp)
+            rec = tp / float(num_positives)
+            prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+            aps.append(voc_ap(rec, prec))
+        return [np.mean(aps)] + aps
+
+    # synthetic VOC test set: 4952 images, detections jittered around the gts plus random false positives
+    rng = np.random.RandomState(0)
+    numimg, numcls, iou_thres = 4952, 20, 0.5
+    gt_count = rng.randint(1, 6, numimg)
+    gt_img = np.repeat(np.arange(numimg), gt_count)
+    xy = rng.randint(0, 400, (len(gt_img), 2))
+    gt_boxes = np.concatenate([xy, xy + rng.randint(10, 200, (len(gt_img), 2))], 1).astype(np.float64)
+    gt_labels = rng.randint(0, numcls, len(gt_img))
+    gt_difficult = rng.rand(len(gt_img)) < 0.1
+    pred_gt = rng.randint(0, len(gt_img), 300000)
+    pred_img = gt_img[pred_gt]
+    pred_boxes = (gt_boxes[pred_gt] + rng.randn(len(pred_gt), 4) * 20).astype(np.float32)
+    pred_labels = np.where(rng.rand(len(pred_gt)) < 0.8, gt_labels[pred_gt], rng.randint(0, numcls, len(pred_gt)))
+    pred_scores = rng.rand(len(pred_gt)).astype(np.float32).astype(np.float64)
+
+    rec_pred = defaultdict(list)
+    for i in range(len(pred_gt)):
+        rec_pred[pred_labels[i]].append({'img_idx': pred_img[i], 'bbox': pred_boxes[i], 'score': pred_scores[i]})
+    rec_gt = defaultdict(list)
+    for i in range(len(gt_img)):
+        rec_gt[gt_img[i]].append({'label': gt_labels[i], 'bbox': gt_boxes[i], 'difficult': gt_difficult[i]})
+    start = time.time()
+    aps_loop = evaluate_loop(rec_pred, rec_gt, numcls, iou_thres)
+    time_loop = time.time() - start
+    start = time.time()
+    aps = evaluate_voc(pred_img, pred_boxes, pred_scores, pred_labels, gt_img, gt_boxes, gt_labels, gt_difficult,
+                       numimg, numcls, iou_thres)
+    time_vec = time.time() - start
+    assert aps == aps_loop, (aps, aps_loop)
+    print("detections:{} mAP:{:.6f} loop:{:.3f}s vectorized:{:.3f}s".format(len(pred_gt), aps[0], time_loop, time_vec))
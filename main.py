@@ -10,7 +10,7 @@ from thop import profile,clever_format
 def main(args):
     gpus=[str(g) for g in args.devices]
     os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(gpus)
-    net = eval(cfg.MODEL.modeltype)(cfg=args.MODEL).cuda()
+    net = eval(cfg.MODEL.modeltype)(cfg=args.MODEL).to('cuda' if torch.cuda.is_available() else 'cpu')
 
     # inp = torch.ones(1, 3, 320, 320).cuda()
     # flops, params = profile(net, inputs=(inp,), verbose=False)
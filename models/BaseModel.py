@@ -2,6 +2,36 @@ from models.backbone import *
 from models.backbone.helper import *
 from models.backbone.baseblock import *
 import utils.GIOU as GIOUloss
+from utils.target_util import build_yolo_target, dense_yolo_target
+import functools
+
+
+def _autocast_enabled(device_type):
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:
+        # torch<2.4 takes no device type
+        if device_type == 'cuda':
+            return torch.is_autocast_enabled()
+        return getattr(torch, 'is_autocast_cpu_enabled', lambda: False)()
+
+
+def fp32_loss(loss):
+    """
+    Run the loss(and the target building inside it) with autocast disabled and the predictions in fp32,
+    the iou terms and bce of bf16 predictions lose too much precision.
+    """
+
+    @functools.wraps(loss)
+    def wrapper(self, preds, *args, **kwargs):
+        preds = [p.float() for p in preds]
+        device_type = preds[0].device.type
+        if not _autocast_enabled(device_type):
+            return loss(self, preds, *args, **kwargs)
+        with torch.autocast(device_type, enabled=False):
+            return loss(self, preds, *args, **kwargs)
+
+    return wrapper
 
 
 class BaseModel(nn.Module):
@@ -12,28 +42,41 @@ class BaseModel(nn.Module):
         self.gt_per_grid = cfg.gt_per_grid
         self.backbone = eval(cfg.backbone)(pretrained=cfg.backbone_pretrained)
         self.outC = self.backbone.backbone_outchannels
+        self.input_norm = InputNorm()
         self.heads = []
         self.activate_type = 'relu6'
         self.input_size = 512
         self.bcelogit_loss = torch.nn.BCEWithLogitsLoss(reduction='none')
         self.smooth_loss = torch.nn.SmoothL1Loss(reduction='none')
+        # (gridsize,gt_per_grid,device,dtype)->grid, only holds the grids of grid_cache_size
+        self.grid_cache = {}
+        self.grid_cache_size = None
 
-    def get_grid(self, bz, gridsize):
-        shiftx = torch.arange(0, gridsize, dtype=torch.float32)
-        shifty = torch.arange(0, gridsize, dtype=torch.float32)
-        shifty, shiftx = torch.meshgrid([shiftx, shifty])
-        shiftx = shiftx.unsqueeze(-1).repeat(bz, 1, 1, self.gt_per_grid)
-        shifty = shifty.unsqueeze(-1).repeat(bz, 1, 1, self.gt_per_grid)
-        xy_grid = torch.stack([shiftx, shifty], dim=4).cuda()
-        return xy_grid
+    def get_grid(self, gridsize, device, dtype=torch.float32):
+        """
+        :return: [1,gridsize,gridsize,1,2] xy offset of each grid, broadcasts over batch and gt_per_grid
+        """
+        # multi-scale training changes the input size, drop the grids of the old size
+        if self.grid_cache_size != self.input_size:
+            self.grid_cache = {}
+            self.grid_cache_size = self.input_size
+        key = (gridsize, self.gt_per_grid, device, dtype)
+        if key not in self.grid_cache:
+            shiftx = torch.arange(0, gridsize, dtype=dtype, device=device)
+            shifty = torch.arange(0, gridsize, dtype=dtype, device=device)
+            shifty, shiftx = torch.meshgrid([shiftx, shifty])
+            self.grid_cache[key] = torch.stack([shiftx, shifty], dim=-1)[None, :, :, None, :]
+        return self.grid_cache[key]
 
     def decode(self, output, stride):
         bz = output.shape[0]
         gridsize = output.shape[-1]
+        # the heads run in bf16 under autocast, the box coordinates need fp32
+        output = output.float()
         output = output.permute(0, 2, 3, 1)
         output = output.view(bz, gridsize, gridsize, self.gt_per_grid, 5 + self.numclass)
         x1y1, x2y2, conf, prob = torch.split(output, [2, 2, 1, self.numclass], dim=4)
-        xy_grid = self.get_grid(bz, gridsize)
+        xy_grid = self.get_grid(gridsize, output.device, output.dtype)
         x1y1 = (xy_grid + 0.5 - torch.exp(x1y1)) * stride
         x2y2 = (xy_grid + 0.5 + torch.exp(x2y2)) * stride
 
@@ -45,11 +88,13 @@ class BaseModel(nn.Module):
     def decode_infer(self, output, stride):
         bz = output.shape[0]
         gridsize = output.shape[-1]
+        # the heads run in bf16 under autocast, the box coordinates need fp32
+        output = output.float()
 
         output = output.permute(0, 2, 3, 1)
         output = output.view(bz, gridsize, gridsize, self.gt_per_grid, 5 + self.numclass)
         x1y1, x2y2, conf, prob = torch.split(output, [2, 2, 1, self.numclass], dim=4)
-        xy_grid = self.get_grid(bz, gridsize)
+        xy_grid = self.get_grid(gridsize, output.device, output.dtype)
 
         x1y1 = (xy_grid + 0.5 - torch.exp(x1y1)) * stride
         x2y2 = (xy_grid + 0.5 + torch.exp(x2y2)) * stride
@@ -61,8 +106,9 @@ class BaseModel(nn.Module):
         output = output.view(bz, -1, 5 + self.numclass)
         return output
 
-    def forward(self, input, targets=None):
+    def forward(self, input, targets=None, assigned=None):
         self.input_size = input.shape[-1]
+        input = self.input_norm(input)
         feat_small, feat_mid, feat_large = self.backbone(input)
         conv = self.headslarge(feat_large)
         convlarge = conv
@@ -87,7 +133,7 @@ class BaseModel(nn.Module):
             predlarge = self.decode(outlarge, 32)
             predmid = self.decode(outmid, 16)
             predsmall = self.decode(outsmall, 8)
-            return self.loss([predsmall, predmid, predlarge], targets)
+            return self.loss([predsmall, predmid, predlarge], targets, assigned)
         else:
             predlarge = self.decode_infer(outlarge, 32)
             predmid = self.decode_infer(outmid, 16)
@@ -95,10 +141,12 @@ class BaseModel(nn.Module):
             pred = torch.cat([predsmall, predmid, predlarge], dim=1)
             return pred
 
-    def loss(self, preds: list, gtbox: list):
+    @fp32_loss
+    def loss(self, preds: list, gtbox: list, assigned=None):
         """
         :param preds: [feat1,feat2,feat3]->[bz,pointnum,5+self.numclass]
         :param gtbox: gtbox and label for each image, [bz,[N,5]]
+        :param assigned: (anchor_idx,anchor_target) built by the dataloader, see DATASET.target_in_worker
         :return:
         """
 
@@ -106,7 +154,7 @@ class BaseModel(nn.Module):
             focal = alpha * torch.pow(torch.abs(target - actual), gamma)
             return focal
 
-        cls_reg_targets = self.build_target(gtbox, preds)
+        cls_reg_targets = self.build_target(gtbox, preds, assigned)
         preds = torch.cat(preds, dim=1)
 
         pred_coor = preds[..., 0:4]
@@ -165,8 +213,29 @@ class BaseModel(nn.Module):
         prob_loss = prob_loss * label_mixw
         return bbox_loss, conf_loss, prob_loss
 
-    def build_target(self, bboxs: list, preds):
-        raise NotImplementedError
+    def build_target(self, bboxs: list, preds, assigned=None):
+        """
+        :param bboxs: gtbox,label and mixup weight for each image, [bz,[N,6]]
+        :param preds: [feat1,feat2,feat3]->[bz,pointnum,C], decoded boxes come first
+        :param assigned: (anchor_idx,anchor_target) from assign_yolo_target, built here if None
+        :return: [bz,pointnum,6+self.numclass+1], the last channel is respond_bgd
+        """
+        if assigned is None:
+            target = build_yolo_target(bboxs, self.input_size, self.numclass, self.gt_per_grid)
+        else:
+            target = dense_yolo_target(*assigned, len(bboxs), sum(p.shape[1] for p in preds))
+        preds = torch.cat([p[..., :4] for p in preds], dim=1).detach()
+        respond_bgd = []
+        for target_img, bbox, pred in zip(target, bboxs, preds):
+            # ignore the anchors overlapping with any gt
+            iou = GIOUloss.bbox_overlaps(pred, bbox[:, :4])
+            if iou.shape[-1] > 0:
+                max_iou, _ = torch.max(iou, dim=-1)
+            else:
+                max_iou = torch.zeros_like(pred[:, 0])
+            max_iou = max_iou.unsqueeze(-1)
+            respond_bgd.append((torch.ones_like(target_img[:, 4:5]) - target_img[:, 4:5]) * (max_iou < 0.5).float())
+        return torch.cat([target, torch.stack(respond_bgd, 0)], -1)
 
 
 
@@ -132,6 +132,8 @@ class InvertedResidual(nn.Module):
         assert stride in [1, 2]
         hidden_dim = round(inp * expand_ratio)
         self.use_res_connect = self.stride == 1 and inp == oup
+        # a plain add in float, becomes a quantized add after utils/quant_util.quantize_model
+        self.skip_add = nn.quantized.FloatFunctional()
         if expand_ratio == 1:
             self.conv = nn.Sequential(OrderedDict([
                 ('dw_conv', nn.Conv2d(hidden_dim, hidden_dim, 3, stride, 1, groups=hidden_dim, bias=False)),
@@ -157,7 +159,7 @@ class InvertedResidual(nn.Module):
 
     def forward(self, x):
         if self.use_res_connect:
-            return x + self.conv(x)
+            return self.skip_add.add(x, self.conv(x))
         else:
             return self.conv(x)
 
@@ -180,6 +182,19 @@ class DarknetBlock(nn.Module):
         out = self.darkblock(x)
         out += x
         return out
+
+
+class InputNorm(nn.Module):
+    """
+    uint8 images(DATASET.uint8) -> float in [0,1] in a single op on the model's device, float images pass through.
+    """
+
+    def forward(self, x):
+        if x.dtype == torch.uint8:
+            return torch.mul(x, 1.0 / 255)
+        return x
+
+
 if __name__ == '__main__':
     model=ASFF(1,activate='leaky')
     l1=torch.ones(1,512,10,10)
@@ -2,8 +2,9 @@ import torch
 from collections import OrderedDict
 import pickle
 from utils.dist_util import *
+from utils.ckpt_util import load_ckpt_file
 def load_mobilev2(model,ckpt):
-    weights = torch.load(ckpt,map_location='cuda:{}'.format(get_rank()))
+    weights = load_ckpt_file(ckpt)
     statedict=model.state_dict()
     newstatedict=OrderedDict()
     for k,v in model.state_dict().items():
@@ -57,62 +57,6 @@ class StrongerV3(BaseModel):
             self.asff1 = ASFF(1, activate=self.activate_type)
             self.asff2 = ASFF(2, activate=self.activate_type)
 
-    def build_target(self, bboxs: list, preds):
-        # get target for each image
-        batch_targets = []
-        batch_preds = []
-        for idx_img in range(preds[0].shape[0]):
-            batch_preds.append(torch.cat([p[idx_img] for p in preds], 0))
-        for bbox, pred in zip(bboxs, batch_preds):
-            batch_targets.append(self.yolo_target_single(bbox, pred))
-        batch_targets = torch.stack(batch_targets, 0)
-        return batch_targets
-
-    def yolo_target_single(self, target: torch.Tensor, pred: torch.Tensor):
-
-        bbox, class_label, mix_weight = target.split([4, 1, 1], dim=1)
-        class_label = class_label.long()
-        reg_area_limit = [0, 30, 90, 10000]
-        strides = [8, 16, 32]
-        target_lvl = [torch.zeros(self.input_size // strides[i], self.input_size // strides[i], self.gt_per_grid,
-                                  6 + self.numclass).cuda() for i in range(3)]
-        target_count = [torch.zeros(self.input_size // strides[i], self.input_size // strides[i]).long() for i in
-                        range(3)]
-        bbox_xywh = torch.cat([(bbox[:, 2:] + bbox[:, :2]) * 0.5,
-                               bbox[:, 2:] - bbox[:, :2]], dim=-1)
-        bboxarea = torch.sqrt(bbox_xywh[:, -2] * bbox_xywh[:, -1])
-        for i in range(3):
-            # initialize box weight 1
-            target_lvl[i][:, :, :, 5] = 1.0
-            valid_mask = (bboxarea > reg_area_limit[i]) & (bboxarea < reg_area_limit[i + 1])
-            for gt_xywh, class_index, gt_xyxy, box_weight in zip(bbox_xywh[valid_mask], class_label[valid_mask],
-                                                                 bbox[valid_mask], mix_weight[valid_mask]):
-                gt_xywh = (gt_xywh / strides[i]).long()
-                numgt = target_count[i][gt_xywh[1]][gt_xywh[0]]
-                delta = 0.01
-                if numgt==0 and self.gt_per_grid>1:
-                    for n in range(self.gt_per_grid):
-                        target_lvl[i][gt_xywh[1]][gt_xywh[0]][n][:4] = gt_xyxy
-                        target_lvl[i][gt_xywh[1]][gt_xywh[0]][n][4] = 1.0
-                        target_lvl[i][gt_xywh[1]][gt_xywh[0]][n][5] = box_weight
-                        target_lvl[i][gt_xywh[1]][gt_xywh[0]][n][6:] = 1.0 / self.numclass * delta
-                        target_lvl[i][gt_xywh[1]][gt_xywh[0]][n][6 + class_index] = (1.0 - delta) + 1.0 / self.numclass * delta
-                else:
-                    target_lvl[i][gt_xywh[1]][gt_xywh[0]][numgt][:4] = gt_xyxy
-                    target_lvl[i][gt_xywh[1]][gt_xywh[0]][numgt][4] = 1.0
-                    target_lvl[i][gt_xywh[1]][gt_xywh[0]][numgt][5] = box_weight
-                    target_lvl[i][gt_xywh[1]][gt_xywh[0]][numgt][6:] = 1.0 / self.numclass * delta
-                    target_lvl[i][gt_xywh[1]][gt_xywh[0]][numgt][6 + class_index] = (1.0 - delta) + 1.0 / self.numclass * delta
-                target_count[i][gt_xywh[1]][gt_xywh[0]] = min(self.gt_per_grid - 1,target_count[i][gt_xywh[1]][gt_xywh[0]] + 1)
-        target_lvl = [t.view(-1, 6 + self.numclass) for t in target_lvl]
-        target_lvl = torch.cat(target_lvl, 0)
-        iou = GIOUloss.bbox_overlaps(pred[:, :4], target[:, :4])
-        max_iou, _ = torch.max(iou, dim=-1)
-        max_iou = max_iou.unsqueeze(-1)
-        respond_bgd = (torch.ones_like(target_lvl[:, 4:5]) - target_lvl[:, 4:5]) * (max_iou < 0.5).float()
-        # respond_bgd = (torch.ones_like(target_lvl[:,4:5])- target_lvl[:,4:5])
-        target_lvl = torch.cat([target_lvl, respond_bgd], -1)
-        return target_lvl
 
 
 if __name__ == '__main__':
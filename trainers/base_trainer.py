@@ -2,11 +2,16 @@ from utils.util import ensure_dir
 from dataset import get_COCO, get_VOC,get_Custom
 import os
 import time
+import contextlib
 from dataset import makeImgPyramids
 from models.backbone.baseblock_US import bn_calibration_init
-from utils.nms_utils import torch_nms
+from utils.nms_utils import torch_nms_batched
+from utils.detector import postprocess_boxes
 from tensorboardX import SummaryWriter
-from utils.util import AverageMeter
+from utils.util import AverageMeter, BackgroundWorker, match_state_dict
+from utils.profile_util import StepProfiler
+from utils.tta_util import tta_enabled, tta_forward, merge_views
+from utils.ckpt_util import CheckpointWriter, load_ckpt_file
 import torch
 import matplotlib.pyplot as plt
 from models.backbone.helper import load_tf_weights
@@ -53,12 +58,19 @@ class BaseTrainer:
         self.metric_evaluate = None
         self.best_mAP = 0
         self.writer = None
+        self.ckpt_writer = CheckpointWriter(self.args.EXPER.ckpt_async, self.args.EXPER.ckpt_keep,
+                                            self.args.EXPER.ckpt_half)
+        self.profiler = StepProfiler(enabled=self.args.LOG.profile or self.args.LOG.trace_steps > 0)
+        # device of the training and validation inputs, the one the model is on(cpu without cuda)
+        self.device = next(self.model.parameters()).device
         # initialize
         self._get_dataset()
         self._get_model()
         self._get_SummaryWriter()
         self._get_loggers()
         self.sparseBN = []
+        if self.profiler.enabled:
+            self.profiler.instrument(self.model)
 
     def _save_ckpt(self, metric, name=None):
         state = {
@@ -69,41 +81,20 @@ class BaseTrainer:
             'metric': metric
         }
         if name == None:
-            torch.save(state, os.path.join(self.save_path, 'checkpoint-{}.pth'.format(self.global_iter)))
+            self.ckpt_writer.save(state, os.path.join(self.save_path, 'checkpoint-{}.pth'.format(self.global_iter)),
+                                  group='iter')
         else:
-            torch.save(state, os.path.join(self.save_path, 'checkpoint-{}.pth'.format(name)))
+            self.ckpt_writer.save(state, os.path.join(self.save_path, 'checkpoint-{}.pth'.format(name)))
         print("save checkpoints at iter{}".format(self.global_iter))
 
     def _load_ckpt(self):
         if self.args.EXPER.resume == "load_voc":
             load_tf_weights(self.model, 'vocweights.pkl')
         else:  # iter or best
-            ckptfile = torch.load(os.path.join(self.save_path, 'checkpoint-{}.pth'.format(self.args.EXPER.resume)))
-            # take care of the distributed model
-            if 'module.' in list(self.model.state_dict().keys())[0]:
-                newdict = OrderedDict()
-                for k, v in ckptfile['state_dict'].items():
-                    if 'module.' not in k:
-                        newdict['module.' + k] = v
-                    else:
-                        newdict[k] = v
-                ckptfile['state_dict'] = newdict
-            else:
-                newdict = OrderedDict()
-                for k, v in ckptfile['state_dict'].items():
-                    if 'module.' in k:
-                        newdict[k[7:]] = v
-                    else:
-                        newdict[k] = v
-                ckptfile['state_dict'] = newdict
-            # check the consistency
-            for k,v in ckptfile['state_dict'].items():
-                if k not in self.model.state_dict():
-                    ckptfile['state_dict'].pop(k)
-            for (k1,v1) in self.model.state_dict().items():
-                if k1 not in ckptfile['state_dict'] or ckptfile['state_dict'][k1].shape!=self.model.state_dict()[k1].shape:
-                    print("weight {} will be initialized from scratch".format(k1))
-                    ckptfile['state_dict'][k1]=self.model.state_dict()[k1]
+            # memory-mapped on cpu, the spawned test/finetune workers of pruning only read the weights they copy
+            ckptfile = load_ckpt_file(os.path.join(self.save_path, 'checkpoint-{}.pth'.format(self.args.EXPER.resume)))
+            ckptfile['state_dict'] = match_state_dict(self.model.state_dict(), ckptfile['state_dict'],
+                                                      verbose=is_main_process())
             # just ignore the bn_not_save parameters
             self.model.load_state_dict(ckptfile['state_dict'], strict=True)
             # load_checkpoint(self.model,ckptfile)
@@ -154,10 +145,28 @@ class BaseTrainer:
         self.LossConf.reset()
         self.LossBox.reset()
 
+    def autocast(self, device):
+        """
+        bf16 autocast of the network when OPTIM.amp, see fp32_loss of BaseModel for the parts kept in fp32
+        """
+        if not self.args.OPTIM.amp:
+            return contextlib.nullcontext()
+        return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
+
     def updateBN(self):
         for m in self.sparseBN:
             m.weight.grad.data.add_(self.args.Prune.sr * torch.sign(m.weight.data))
 
+    def _log_profile(self):
+        summary = self.profiler.summary()
+        self.profiler.reset()
+        if not summary or not is_main_process():
+            return
+        print("profile: " + " ".join("{}:{:.3f}".format(k, v) for k, v in summary.items()))
+        if self.writer is not None:
+            for k, v in summary.items():
+                self.writer.add_scalar("profile/{}".format(k), v, global_step=self.global_iter)
+
     def train(self):
         if self.args.Prune.sparse:
             allbns = []
@@ -170,6 +179,9 @@ class BaseTrainer:
                         continue
                     self.sparseBN.append(m[1])
             print("{}/{} bns will be sparsed.".format(len(self.sparseBN), len(allbns)))
+        if self.args.LOG.trace_steps > 0 and is_main_process():
+            self.profiler.start_trace(os.path.join('./summary/', self.experiment_name, 'trace'),
+                                      self.args.LOG.trace_steps)
         for epoch in range(self.global_epoch, self.args.OPTIM.total_epoch):
             self.global_epoch += 1
             self._train_epoch()
@@ -197,17 +209,17 @@ class BaseTrainer:
                     self._reset_loggers()
             if epoch % 5 == 0 and is_main_process():
                 self._save_ckpt(metric=0)
+        self.profiler.stop_trace()
+        self.ckpt_writer.wait()
 
     def _train_epoch(self):
         synchronize()
         self.model.train()
+        self.profiler.start_epoch()
         # for i, inputs in tqdm(enumerate(self.train_dataloader), total=len(self.train_dataloader)):
         for i, inputs in enumerate(self.train_dataloader):
-            inputs = [input if isinstance(input, list) else input.squeeze(0) for input in inputs]
-            img, _, _, gtbox = inputs
-            # img, _, _, *gtbox = inputs
-
-            gtbox = [g.squeeze(0) for g in gtbox]
+            self.profiler.start_step()
+            img, _, _, gtbox, *assigned = inputs
             self.global_iter += 1
 
             if self.global_iter % 50 == 0 and is_main_process():
@@ -215,30 +227,45 @@ class BaseTrainer:
                 for k, v in self.logger_losses.items():
                     print(k, ":", v.get_avg())
             if self.args.EXPER.US_training:
-                self.train_step_US(img, gtbox)
+                self.train_step_US(img, gtbox, assigned)
             else:
-                self.train_step(img, gtbox)
+                self.train_step(img, gtbox, assigned)
+            self.profiler.end_step(img.shape[0])
+            if self.profiler.enabled and self.global_iter % self.log_iter == 0:
+                self._log_profile()
 
-    def train_step(self, imgs, gtbox):
-        imgs = imgs.cuda()
-        gtbox=[g.cuda() for g in gtbox]
-        bbox_loss, conf_loss, prob_loss = self.model(imgs,gtbox)
-        bbox_loss = bbox_loss.sum() / imgs.shape[0]
-        conf_loss = conf_loss.sum() / imgs.shape[0]
-        prob_loss = prob_loss.sum() / imgs.shape[0]
-        totalloss = bbox_loss + conf_loss + prob_loss
-        self.optimizer.zero_grad()
-        totalloss.backward()
+    def train_step(self, imgs, gtbox, assigned=None):
+        profiler = self.profiler
+        with profiler.phase('transfer'):
+            imgs = imgs.to(self.device)
+            gtbox=[g.to(self.device) for g in gtbox]
+            # targets assigned by the dataloader workers
+            assigned = [a.to(self.device) for a in assigned] if assigned else None
+        with profiler.phase('forward'), self.autocast(imgs.device):
+            bbox_loss, conf_loss, prob_loss = self.model(imgs, gtbox, assigned)
+            bbox_loss = bbox_loss.sum() / imgs.shape[0]
+            conf_loss = conf_loss.sum() / imgs.shape[0]
+            prob_loss = prob_loss.sum() / imgs.shape[0]
+            totalloss = bbox_loss + conf_loss + prob_loss
+        with profiler.phase('backward'):
+            self.optimizer.zero_grad()
+            totalloss.backward()
         if self.args.Prune.sparse:
-            self.updateBN()
-        self.optimizer.step()
-        self.LossBox.update(bbox_loss.item())
-        self.LossConf.update(conf_loss.item())
-        self.LossClass.update(prob_loss.item())
+            with profiler.phase('updateBN'):
+                self.updateBN()
+        with profiler.phase('optimizer'):
+            self.optimizer.step()
+        with profiler.phase('meters'):
+            self.LossBox.update(bbox_loss.item())
+            self.LossConf.update(conf_loss.item())
+            self.LossClass.update(prob_loss.item())
 
-    def train_step_US(self, imgs, gtbox):
-        imgs = imgs.cuda()
-        gtbox=[g.cuda() for g in gtbox]
+    def train_step_US(self, imgs, gtbox, assigned=None):
+        profiler = self.profiler
+        with profiler.phase('transfer'):
+            imgs = imgs.to(self.device)
+            gtbox=[g.to(self.device) for g in gtbox]
+            assigned = [a.to(self.device) for a in assigned] if assigned else None
 
         self.optimizer.zero_grad()
         widths_train = []
@@ -248,29 +275,32 @@ class BaseTrainer:
             widths_train = [1.0, 0.4] + widths_train
         for idx, width_mult in enumerate(widths_train):
             self.model.apply(lambda m: setattr(m, 'width_mult', width_mult))
-            bbox_loss, conf_loss, prob_loss = self.model(imgs, gtbox)
+            with profiler.phase('forward'), self.autocast(imgs.device):
+                bbox_loss, conf_loss, prob_loss = self.model(imgs, gtbox, assigned)
 
-            bbox_loss = bbox_loss.sum() / imgs.shape[0]
-            conf_loss = conf_loss.sum() / imgs.shape[0]
-            prob_loss = prob_loss.sum() / imgs.shape[0]
+                bbox_loss = bbox_loss.sum() / imgs.shape[0]
+                conf_loss = conf_loss.sum() / imgs.shape[0]
+                prob_loss = prob_loss.sum() / imgs.shape[0]
 
-            totalloss = bbox_loss + conf_loss + prob_loss
-            totalloss.backward()
+                totalloss = bbox_loss + conf_loss + prob_loss
+            with profiler.phase('backward'):
+                totalloss.backward()
             if idx == 0:
-                self.LossBox.update(bbox_loss.item())
-                self.LossConf.update(conf_loss.item())
-                self.LossClass.update(prob_loss.item())
-        self.optimizer.step()
+                with profiler.phase('meters'):
+                    self.LossBox.update(bbox_loss.item())
+                    self.LossConf.update(conf_loss.item())
+                    self.LossClass.update(prob_loss.item())
+        with profiler.phase('optimizer'):
+            self.optimizer.step()
 
     def _cal_bn(self):
         self.model.apply(bn_calibration_init)
         for idx_batch, inputs in tqdm(enumerate(self.train_dataloader)):
             if idx_batch == 100:
                 break
-            inputs = [input if isinstance(input, list) else input.squeeze(0) for input in inputs]
             (imgs, imgpath, ori_shapes, *_) = inputs
-            imgs = imgs.cuda()
-            with torch.no_grad():
+            imgs = imgs.to(self.device)
+            with torch.no_grad(), self.autocast(self.device):
                 self.model(imgs)
 
     def _valid_epoch(self, validiter=-1, width_mult=-1, cal_bn=False, verbose=False):
@@ -285,72 +315,44 @@ class BaseTrainer:
                     self._cal_bn()
         synchronize()
 
-        def _postprocess(pred_bbox, test_input_size, org_img_shape):
-            if self.args.MODEL.boxloss == 'KL':
-                pred_coor = pred_bbox[:, 0:4]
-                pred_vari = pred_bbox[:, 4:8]
-                pred_vari = torch.exp(pred_vari)
-                pred_conf = pred_bbox[:, 8]
-                pred_prob = pred_bbox[:, 9:]
-            else:
-                pred_coor = pred_bbox[:, 0:4]
-                pred_conf = pred_bbox[:, 4]
-                pred_prob = pred_bbox[:, 5:]
-            org_h, org_w = org_img_shape
-            resize_ratio = min(1.0 * test_input_size / org_w, 1.0 * test_input_size / org_h)
-            dw = (test_input_size - resize_ratio * org_w) / 2
-            dh = (test_input_size - resize_ratio * org_h) / 2
-            pred_coor[:, 0::2] = 1.0 * (pred_coor[:, 0::2] - dw) / resize_ratio
-            pred_coor[:, 1::2] = 1.0 * (pred_coor[:, 1::2] - dh) / resize_ratio
-            x1, y1, x2, y2 = torch.split(pred_coor, [1, 1, 1, 1], dim=1)
-            x1, y1 = torch.max(x1, torch.zeros_like(x1)), torch.max(y1, torch.zeros_like(y1))
-            x2, y2 = torch.min(x2, torch.ones_like(x2) * (org_w - 1)), torch.min(y2, torch.ones_like(y2) * (org_h - 1))
-            pred_coor = torch.cat([x1, y1, x2, y2], dim=-1)
-
-            # ***********************
-            if pred_prob.shape[-1] == 0:
-                pred_prob = torch.ones((pred_prob.shape[0], 1)).cuda()
-            # ***********************
-            scores = pred_conf.unsqueeze(-1) * pred_prob
-            bboxes = torch.cat([pred_coor, scores], dim=-1)
-            if self.args.MODEL.boxloss == 'KL' and self.args.EVAL.varvote:
-                return bboxes, pred_vari
-            else:
-                return bboxes, None
+        def _process_batch(outputs, test_input_size, ori_shapes, imgpath):
+            with torch.no_grad():
+                bboxes, bboxvari = postprocess_boxes(outputs, test_input_size, ori_shapes, self.args.MODEL.boxloss,
+                                                     self.args.EVAL.varvote)
+                nms_results = merge_views(self.args.EVAL, bboxes, variance=bboxvari)
+            self.TESTevaluator.update(imgpath, nms_results)
 
+        # postprocess,nms and evaluation of a batch run on a thread while the next batch goes through the model
+        if self.args.EVAL.pipeline_depth > 0:
+            worker = BackgroundWorker(_process_batch, maxsize=self.args.EVAL.pipeline_depth, name='valid_postprocess')
+        else:
+            worker = None
         self.model.eval()
-        for idx_batch, inputs in tqdm(enumerate(self.test_dataloader), total=len(self.test_dataloader)):
-        # for idx_batch, inputs in enumerate(self.test_dataloader):
-            if idx_batch == validiter:  # to save time
-                break
-            inputs = [input if isinstance(input, list) else input.squeeze(0) for input in inputs]
-            (imgs, imgpath, ori_shapes, *_) = inputs
-            imgs = imgs.cuda()
-            ori_shapes = ori_shapes.cuda()
-            with torch.no_grad():
-                outputs = self.model(imgs)
-            for imgidx in range(len(outputs)):
-                bbox, bboxvari = _postprocess(outputs[imgidx], imgs.shape[-1], ori_shapes[imgidx])
-                nms_boxes, nms_scores, nms_labels = torch_nms(self.args.EVAL, bbox,
-                                                              variance=bboxvari)
-                if nms_boxes is not None:
-                    self.TESTevaluator.append(imgpath[imgidx][0],
-                                              nms_boxes.cpu().numpy(),
-                                              nms_scores.cpu().numpy(),
-                                              nms_labels.cpu().numpy())
+        try:
+            for idx_batch, inputs in tqdm(enumerate(self.test_dataloader), total=len(self.test_dataloader)):
+            # for idx_batch, inputs in enumerate(self.test_dataloader):
+                if idx_batch == validiter:  # to save time
+                    break
+                (imgs, imgpath, ori_shapes, *_) = inputs
+                imgs = imgs.to(self.device)
+                ori_shapes = ori_shapes.to(self.device)
+                with torch.no_grad(), self.autocast(self.device):
+                    if tta_enabled(self.args.EVAL):
+                        outputs = tta_forward(self.model, imgs, self.args.EVAL.tta_scales, self.args.EVAL.tta_flip,
+                                              self.args.MODEL.boxloss)
+                    else:
+                        outputs = self.model(imgs)
+                if worker is not None:
+                    worker.submit(outputs, imgs.shape[-1], ori_shapes, imgpath)
+                else:
+                    _process_batch(outputs, imgs.shape[-1], ori_shapes, imgpath)
+        finally:
+            # also stops the worker thread when the forward or the dataloader raises
+            if worker is not None:
+                worker.join()
         ## accumulate prediction results across gpus
-        results = all_gather(self.TESTevaluator.rec_pred)
+        self.TESTevaluator.merge()
         if is_main_process():
-            if isinstance(self.TESTevaluator,EvaluatorCOCO):
-                all_recs=[]
-                for rec in results:
-                    all_recs.extend(rec)
-            else:
-                all_recs = defaultdict(list)
-                for rec in results:
-                    for k, v in rec.items():
-                        all_recs[k].extend(v)
-            self.TESTevaluator.rec_pred = all_recs
             results = self.TESTevaluator.evaluate()
             imgs = self.TESTevaluator.visual_imgs
             if verbose and is_main_process():
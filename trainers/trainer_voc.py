@@ -1,5 +1,6 @@
 from trainers.base_trainer import BaseTrainer
 from evaluator.voceval import EvaluatorVOC
+from utils.dataset_util import get_index_path
 
 class Trainer(BaseTrainer):
   def __init__(self, args, model, optimizer,lrscheduler):
@@ -12,6 +13,7 @@ class Trainer(BaseTrainer):
                                       rootpath=self.dataset_root,
                                       score_thres=0.01,
                                       iou_thres=self.args.EVAL.iou_thres,
-                                      use_07_metric=False
+                                      use_07_metric=False,
+                                      indexpath=get_index_path(self.args.DATASET.anno_index, 'VOC_2007test')
                                       )
     self.logger_custom = ['mAP']+['AP@{}'.format(cls) for cls in self.labels]
\ No newline at end of file
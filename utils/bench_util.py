@@ -0,0 +1,163 @@
+# coding: utf-8
+
+import json
+import platform
+import time
+import numpy as np
+import torch
+import models
+
+
+def random_gtbox(bz, size, numbox=8, numcls=20, seed=0):
+    """
+    :return: [bz,[numbox,6]] random gt (x1y1x2y2,label,mixweight) inside a size x size image
+    """
+    rng = np.random.RandomState(seed)
+    gtbox = []
+    for _ in range(bz):
+        xy = rng.uniform(0, size * 0.7, (numbox, 2))
+        wh = rng.uniform(size * 0.05, size * 0.3, (numbox, 2))
+        label = rng.randint(0, numcls, (numbox, 1))
+        gtbox.append(torch.from_numpy(np.concatenate([xy, xy + wh, label, np.ones((numbox, 1))], 1).astype(np.float32)))
+    return gtbox
+
+
+def summarize(times):
+    """
+    :param times: seconds of each timed iteration
+    :return: mean and percentiles in ms
+    """
+    times = np.array(times) * 1000
+    return {'mean_ms': float(times.mean()), 'p50_ms': float(np.percentile(times, 50)),
+            'p90_ms': float(np.percentile(times, 90)), 'p99_ms': float(np.percentile(times, 99))}
+
+
+def bench_model(model, size, bz, warmup=2, iters=5):
+    """
+    Time forward(eval mode), forward+loss and backward(train mode) of one input size and batch size on cpu.
+    :return: {phase: summary}
+    """
+    inp = torch.rand(bz, 3, size, size)
+    gtbox = random_gtbox(bz, size, numcls=model.numclass)
+    results = {}
+    model.eval()
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + iters):
+            start = time.perf_counter()
+            model(inp)
+            times.append(time.perf_counter() - start)
+    results['forward'] = summarize(times[warmup:])
+
+    model.train()
+    times_fwd, times_bwd = [], []
+    for i in range(warmup + iters):
+        model.zero_grad()
+        start = time.perf_counter()
+        bbox_loss, conf_loss, prob_loss = model(inp, gtbox)
+        totalloss = (bbox_loss.sum() + conf_loss.sum() + prob_loss.sum()) / bz
+        times_fwd.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        totalloss.backward()
+        times_bwd.append(time.perf_counter() - start)
+    results['forward_loss'] = summarize(times_fwd[warmup:])
+    results['backward'] = summarize(times_bwd[warmup:])
+    return results
+
+
+def bench_config(cfg, name, batch_sizes=(1,), widths=(1.0, 0.4), warmup=2, iters=5):
+    """
+    Benchmark the model of a config at each of EXPER.train_sizes/test_size, batch size and width(US models only).
+    :return: list of result records
+    """
+    torch.manual_seed(0)
+    model = getattr(models, cfg.MODEL.modeltype)(cfg=cfg.MODEL)
+    widths = widths if cfg.EXPER.US_training else (None,)
+    records = []
+    for size in sorted(set(cfg.EXPER.train_sizes) | {cfg.EXPER.test_size}):
+        for bz in batch_sizes:
+            for width in widths:
+                if width is not None:
+                    model.apply(lambda m: setattr(m, 'width_mult', width))
+                for phase, summary in bench_model(model, size, bz, warmup, iters).items():
+                    record = {'config': name, 'model': cfg.MODEL.modeltype, 'size': size, 'batch': bz,
+                              'width': width, 'phase': phase}
+                    record.update(summary)
+                    records.append(record)
+                    print("{config} {model} size:{size} batch:{batch} width:{width} {phase}: "
+                          "mean {mean_ms:.1f}ms p50 {p50_ms:.1f}ms p90 {p90_ms:.1f}ms".format(**record))
+    return records
+
+
+def record_key(record):
+    return record['config'], record['size'], record['batch'], record['width'], record['phase']
+
+
+def compare(records, baseline, tolerance=0.1):
+    """
+    :param baseline: records of a previous run
+    :param tolerance: a p50 slower than the baseline by more than this ratio is a regression
+    :return: regressed records with the baseline p50 and the ratio
+    """
+    base = {record_key(r): r for r in baseline}
+    regressions = []
+    for record in records:
+        key = record_key(record)
+        if key not in base:
+            continue
+        ratio = record['p50_ms'] / base[key]['p50_ms']
+        if ratio > 1 + tolerance:
+            regressions.append(dict(record, baseline_p50_ms=base[key]['p50_ms'], ratio=ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    import glob
+    import os
+    import sys
+    from yacscfg import _C
+
+    parser = argparse.ArgumentParser(description="forward/backward latency benchmark of the configs on cpu")
+    parser.add_argument("--configs", nargs='+', default=sorted(glob.glob('configs/*.yaml')))
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[1])
+    parser.add_argument("--widths", type=float, nargs='+', default=[1.0, 0.4], help="width_mult of the US models")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="torch cpu threads, 0 keeps the default")
+    parser.add_argument("--output", default='benchmark.json')
+    parser.add_argument("--baseline", default=None, help="json of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    records, errors = [], {}
+    for configfile in args.configs:
+        cfg = _C.clone()
+        name = os.path.splitext(os.path.basename(configfile))[0]
+        try:
+            cfg.merge_from_file(configfile)
+            cfg.MODEL.backbone_pretrained = ''
+            cfg.freeze()
+            records.extend(bench_config(cfg, name, args.batch_sizes, args.widths, args.warmup, args.iters))
+        except Exception as e:
+            # configs of removed options or models are reported, not fatal
+            errors[name] = repr(e)
+            print("{} failed: {!r}".format(name, e))
+    result = {'torch': torch.__version__, 'threads': torch.get_num_threads(), 'machine': platform.machine(),
+              'processor': platform.processor(), 'records': records, 'errors': errors}
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=1)
+    print("saved {} records to {}".format(len(records), args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(records, baseline['records'], args.tolerance)
+        for r in regressions:
+            print("REGRESSION {config} size:{size} batch:{batch} width:{width} {phase}: "
+                  "p50 {baseline_p50_ms:.1f}ms -> {p50_ms:.1f}ms ({ratio:.2f}x)".format(**r))
+        print("{} regressions over {:.0%} against {}".format(len(regressions), args.tolerance, args.baseline))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,158 @@
+# coding: utf-8
+
+import os
+import threading
+from collections import defaultdict
+import torch
+
+
+def snapshot(obj, half=False):
+    """
+    Copy every tensor of a (nested) state to cpu memory, so training can go on while it is written.
+    :param half: store the floating point tensors in fp16
+    """
+    if torch.is_tensor(obj):
+        dtype = torch.float16 if half and obj.is_floating_point() else obj.dtype
+        return obj.detach().to('cpu', dtype=dtype, copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v, half)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v, half) for v in obj)
+    return obj
+
+
+def atomic_save(state, path):
+    """
+    torch.save to a temporary file renamed over path, a crash never leaves a truncated checkpoint behind
+    """
+    tmppath = path + '.tmp'
+    torch.save(state, tmppath)
+    os.replace(tmppath, path)
+
+
+def load_ckpt_file(path):
+    """
+    torch.load to cpu with the tensors memory-mapped(torch>=2.1), only the pages of the tensors that are used get
+    read, so e.g. the optimizer state of a checkpoint loaded for testing is never read from disk.
+    Checkpoints of the legacy(non zip) format and older torch versions fall back to a full load.
+    """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except TypeError:
+        # torch<2.1, no mmap argument
+        return torch.load(path, map_location='cpu')
+    except RuntimeError as e:
+        if 'mmap' not in str(e):
+            raise
+        return torch.load(path, map_location='cpu')
+
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints inline or on a background thread. In async mode save() returns once the state is copied to
+    cpu memory and only waits when the previous write is still running, an error of a write is raised by the next
+    save() or by wait().
+    """
+
+    def __init__(self, async_write=False, keep=0, half=False):
+        """
+        :param keep: files kept of each group passed to save, the oldest is removed, 0 keeps all
+        :param half: store the model weights('state_dict') in fp16, the optimizer state stays fp32
+        """
+        self.async_write = async_write
+        self.keep = keep
+        self.half = half
+        self.thread = None
+        self.error = None
+        self.history = defaultdict(list)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write(self, state, path, group):
+        try:
+            atomic_save(state, path)
+            if group is not None and self.keep > 0:
+                history = self.history[group]
+                if path in history:
+                    history.remove(path)
+                history.append(path)
+                while len(history) > self.keep:
+                    oldpath = history.pop(0)
+                    if os.path.exists(oldpath):
+                        os.remove(oldpath)
+        except BaseException as e:
+            self.error = e
+
+    def save(self, state, path, group=None):
+        """
+        :param state: checkpoint dict, its 'state_dict' goes to fp16 with half
+        :param group: files saved with the same group are rotated(see keep), None is never removed
+        """
+        self.wait()
+        state = {k: snapshot(v, self.half and k == 'state_dict') for k, v in state.items()}
+        if not self.async_write:
+            self._write(state, path, group)
+            self.wait()
+            return
+        self.thread = threading.Thread(target=self._write, args=(state, path, group), name='ckpt_writer',
+                                       daemon=True)
+        self.thread.start()
+
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+    import time
+    import models
+    from yacscfg import _C as cfg
+
+    from utils.util import match_state_dict
+
+    parser = argparse.ArgumentParser(description="time training spends in inline and async checkpoint saves and the "
+                                                 "time to load a checkpoint for testing")
+    parser.add_argument("--config-file", default='configs/strongerv3.yaml')
+    parser.add_argument("--saves", type=int, default=3)
+    parser.add_argument("--dir", default=None, help="directory to write to, a temporary one by default")
+    args = parser.parse_args()
+    cfg.merge_from_file(args.config_file)
+    cfg.MODEL.backbone_pretrained = ''
+
+    model = getattr(models, cfg.MODEL.modeltype)(cfg=cfg.MODEL)
+    optimizer = torch.optim.Adam(model.parameters())
+    model(torch.rand(1, 3, 320, 320), [torch.tensor([[10., 10., 100., 100., 0., 1.]])])[0].sum().backward()
+    optimizer.step()
+    savedir = args.dir or tempfile.mkdtemp()
+    for async_write, half in ((False, False), (True, False), (True, True)):
+        writer = CheckpointWriter(async_write, keep=2, half=half)
+        blocked = 0.0
+        for i in range(args.saves):
+            state = {'iter': i, 'state_dict': model.state_dict(), 'opti_dict': optimizer.state_dict()}
+            start = time.time()
+            writer.save(state, os.path.join(savedir, 'checkpoint-{}.pth'.format(i)), group='iter')
+            blocked += time.time() - start
+            # stands in for an epoch of training
+            time.sleep(1.0)
+        start = time.time()
+        writer.wait()
+        blocked += time.time() - start
+        files = sorted(f for f in os.listdir(savedir) if f.endswith('.pth'))
+        print("async:{} half:{} blocked {:.0f}ms per save, kept {} {:.1f}MB".format(
+            async_write, half, blocked / args.saves * 1000, files,
+            os.path.getsize(os.path.join(savedir, files[-1])) / 2 ** 20))
+        for f in files:
+            os.remove(os.path.join(savedir, f))
+
+    path = os.path.join(savedir, 'checkpoint-load.pth')
+    atomic_save({'iter': 0, 'state_dict': model.state_dict(), 'opti_dict': optimizer.state_dict()}, path)
+    for name, load in (('torch.load', lambda p: torch.load(p, map_location='cpu')), ('mmap', load_ckpt_file)):
+        start = time.time()
+        state_dict = load(path)['state_dict']
+        model.load_state_dict(match_state_dict(model.state_dict(), state_dict), strict=True)
+        print("{} load: {:.0f}ms".format(name, (time.time() - start) * 1000))
+    os.remove(path)
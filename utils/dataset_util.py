@@ -16,8 +16,8 @@ class PascalVocXmlParser(object):
 
     def __init__(self, annfile, labels):
         self.annfile = annfile
-        self.root = self._root_tag(self.annfile)
         self.tree = self._tree(self.annfile)
+        self.root = self.tree.getroot()
         self.labels = labels
 
     def parse(self, filterdiff=True):
@@ -76,3 +76,84 @@ class PascalVocXmlParser(object):
     def _tree(self, fname):
         tree = parse(fname)
         return tree
+
+
+class AnnotationIndex(object):
+    """
+    Boxes, labels, difficult flags and image sizes of a whole split in flat arrays,
+    the objects of image i are rows offsets[i]:offsets[i+1].
+    The index is saved as a single npz and rebuilt when the split, the labels or any annotation file changes.
+    """
+
+    def __init__(self, annfiles, labels, indexpath=None):
+        self.annfiles = list(annfiles)
+        self.labels = list(labels)
+        if indexpath and self._valid(indexpath):
+            index = np.load(indexpath)
+        else:
+            index = self._build()
+            if indexpath:
+                os.makedirs(os.path.dirname(os.path.abspath(indexpath)), exist_ok=True)
+                tmppath = indexpath + '.tmp.npz'
+                np.savez(tmppath, **index)
+                os.replace(tmppath, indexpath)
+        self.boxes = index['boxes']
+        self.classes = index['classes']
+        self.difficult = index['difficult']
+        self.sizes = index['sizes']
+        self.offsets = index['offsets']
+
+    def __len__(self):
+        return len(self.annfiles)
+
+    def _mtimes(self):
+        return np.array([os.stat(f).st_mtime for f in self.annfiles], dtype=np.float64)
+
+    def _valid(self, indexpath):
+        if not os.path.exists(indexpath):
+            return False
+        index = np.load(indexpath)
+        return index['annfiles'].tolist() == self.annfiles and index['labels'].tolist() == self.labels \
+               and np.array_equal(index['mtimes'], self._mtimes())
+
+    def _build(self):
+        boxes, classes, difficult, sizes, offsets = [], [], [], [], [0]
+        for annfile in self.annfiles:
+            parser = PascalVocXmlParser(annfile, self.labels)
+            _, box, label, diff = parser.parse(filterdiff=False)
+            boxes.append(np.asarray(box, dtype=np.float64).reshape(-1, 4))
+            classes.append(np.asarray(label, dtype=np.int64).reshape(-1))
+            difficult.append(np.asarray(diff, dtype=np.bool_).reshape(-1))
+            sizes.append((parser.get_height() or 0, parser.get_width() or 0))
+            offsets.append(offsets[-1] + len(classes[-1]))
+        return dict(boxes=np.concatenate(boxes) if boxes else np.zeros((0, 4)),
+                    classes=np.concatenate(classes) if classes else np.zeros((0,), dtype=np.int64),
+                    difficult=np.concatenate(difficult) if difficult else np.zeros((0,), dtype=np.bool_),
+                    sizes=np.array(sizes, dtype=np.int32).reshape(-1, 2),
+                    offsets=np.array(offsets, dtype=np.int64),
+                    annfiles=np.array(self.annfiles),
+                    labels=np.array(self.labels),
+                    mtimes=self._mtimes())
+
+    def get(self, idx, filterdiff=True):
+        """
+        :return: boxes [N,4] and labels [N] of image idx, like PascalVocXmlParser.parse, plus difficult if not filterdiff
+        """
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        boxes, classes, difficult = self.boxes[start:end], self.classes[start:end], self.difficult[start:end]
+        if filterdiff:
+            return boxes[~difficult], classes[~difficult]
+        return boxes, classes, difficult
+
+    def get_size(self, idx):
+        """
+        :return: (height,width) of image idx
+        """
+        return tuple(self.sizes[idx])
+
+
+def get_index_path(indexdir, name):
+    """
+    :return: path of the annotation index named name under indexdir, None if indexdir is empty
+    """
+    return os.path.join(indexdir, '{}.npz'.format(name)) if indexdir else None
@@ -0,0 +1,264 @@
+# coding: utf-8
+
+import contextlib
+import numpy as np
+import torch
+import cv2
+import models
+import dataset.augment.dataAug as dataAug
+from utils.tta_util import tta_enabled, tta_forward, merge_views
+from utils.nms_utils import torch_nms_batched
+from utils.util import match_state_dict
+from utils.ckpt_util import load_ckpt_file
+from utils.fuse_util import fuse_model
+
+
+def tile_starts(length, tile_size, overlap):
+    """
+    :return: start of each tile along a side of length, the last tile ends at the border
+    """
+    if length <= tile_size:
+        return [0]
+    stride = max(int(tile_size * (1 - overlap)), 1)
+    return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+
+def load_image(path):
+    """
+    :return: BGR image, .npy files(a [H,W,3] uint8 array) are memory-mapped so only the pixels read are loaded
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return cv2.imread(path, cv2.IMREAD_COLOR)
+
+
+def postprocess_boxes(preds, test_input_size, ori_shapes, boxloss='iou', varvote=False):
+    """
+    Map the decoded boxes of a batch from the letterboxed input back to the original images.
+    :param preds: [bz,N,C] output of the model in eval mode
+    :param ori_shapes: [bz,2] (h,w) of the original images
+    :return: boxes [bz,N,4+numcls] (x1y1x2y2 followed by the score of each class),
+            variance [bz,N,4] if boxloss is 'KL' and varvote is on, otherwise None
+    """
+    if boxloss == 'KL':
+        pred_coor = preds[..., 0:4]
+        pred_vari = torch.exp(preds[..., 4:8])
+        pred_conf = preds[..., 8]
+        pred_prob = preds[..., 9:]
+    else:
+        pred_coor = preds[..., 0:4]
+        pred_conf = preds[..., 4]
+        pred_prob = preds[..., 5:]
+    ori_shapes = ori_shapes.to(preds)
+    org_h, org_w = ori_shapes[:, 0:1], ori_shapes[:, 1:2]
+    resize_ratio = torch.min(1.0 * test_input_size / org_w, 1.0 * test_input_size / org_h)
+    dw = (test_input_size - resize_ratio * org_w) / 2
+    dh = (test_input_size - resize_ratio * org_h) / 2
+    x1 = torch.clamp((pred_coor[..., 0] - dw) / resize_ratio, min=0)
+    y1 = torch.clamp((pred_coor[..., 1] - dh) / resize_ratio, min=0)
+    x2 = torch.min((pred_coor[..., 2] - dw) / resize_ratio, org_w - 1)
+    y2 = torch.min((pred_coor[..., 3] - dh) / resize_ratio, org_h - 1)
+    pred_coor = torch.stack([x1, y1, x2, y2], dim=-1)
+    # single-class models only predict the confidence
+    if pred_prob.shape[-1] == 0:
+        pred_prob = pred_conf.new_ones(pred_conf.shape + (1,))
+    scores = pred_conf.unsqueeze(-1) * pred_prob
+    bboxes = torch.cat([pred_coor, scores], dim=-1)
+    if boxloss == 'KL' and varvote:
+        return bboxes, pred_vari
+    return bboxes, None
+
+
+class Detector(object):
+    """
+    Inference without a dataset or evaluator: letterbox a list of BGR images, run the model and nms on the whole batch.
+    """
+
+    def __init__(self, cfg, ckpt=None, device='cpu', fuse=True):
+        """
+        :param cfg: the full yacs config, uses MODEL, EVAL(nms and tta), EXPER.test_size and OPTIM.amp(bf16 inference)
+        :param ckpt: checkpoint saved by the trainer(or a bare state dict), None keeps the initial weights
+        :param fuse: fold the bn layers into the convs, see utils/fuse_util.fuse_model
+        """
+        self.cfg = cfg
+        self.device = torch.device(device)
+        self.test_size = cfg.EXPER.test_size
+        modelcfg = cfg.MODEL.clone()
+        # the checkpoint holds the backbone weights as well
+        modelcfg.defrost()
+        modelcfg.backbone_pretrained = ''
+        self.model = getattr(models, cfg.MODEL.modeltype)(cfg=modelcfg)
+        if ckpt is not None:
+            self._load_ckpt(ckpt)
+        self.model.to(self.device).eval()
+        if fuse:
+            fuse_model(self.model)
+
+    def _load_ckpt(self, ckpt):
+        state_dict = load_ckpt_file(ckpt)
+        if 'state_dict' in state_dict:
+            state_dict = state_dict['state_dict']
+        self.model.load_state_dict(match_state_dict(self.model.state_dict(), state_dict), strict=True)
+
+    def preprocess(self, imgs):
+        """
+        :param imgs: list of [H,W,3] BGR uint8 images
+        :return: input [bz,3,test_size,test_size], ori_shapes [bz,2]
+        """
+        batch = np.empty((len(imgs), 3, self.test_size, self.test_size), dtype=np.float32)
+        for i, img in enumerate(imgs):
+            img = dataAug.img_preprocess2(img, None, (self.test_size, self.test_size), False)
+            batch[i] = img.transpose((2, 0, 1))
+        ori_shapes = np.array([img.shape[:2] for img in imgs], dtype=np.float32)
+        return torch.from_numpy(batch), torch.from_numpy(ori_shapes)
+
+    @torch.no_grad()
+    def forward(self, inputs):
+        """
+        :param inputs: [bz,3,test_size,test_size] output of preprocess
+        :return: decoded predictions of the model(of every tta view)
+        """
+        autocast = torch.autocast(self.device.type, dtype=torch.bfloat16) if self.cfg.OPTIM.amp \
+            else contextlib.nullcontext()
+        with autocast:
+            if tta_enabled(self.cfg.EVAL):
+                return tta_forward(self.model, inputs.to(self.device), self.cfg.EVAL.tta_scales,
+                                   self.cfg.EVAL.tta_flip, self.cfg.MODEL.boxloss)
+            return self.model(inputs.to(self.device))
+
+    def _predict(self, imgs):
+        """
+        :return: boxes [bz,N,4+numcls] in the original images and their variance(see postprocess_boxes)
+        """
+        inputs, ori_shapes = self.preprocess(imgs)
+        return postprocess_boxes(self.forward(inputs), self.test_size, ori_shapes, self.cfg.MODEL.boxloss,
+                                 self.cfg.EVAL.varvote)
+
+    @staticmethod
+    def _to_numpy(boxes, scores, labels):
+        if boxes is None:
+            return (np.zeros((0, 4), dtype=np.float32), np.zeros((0,), dtype=np.float32),
+                    np.zeros((0,), dtype=np.int64))
+        return boxes.cpu().numpy(), scores.cpu().numpy(), labels.cpu().numpy().astype(np.int64)
+
+    @torch.no_grad()
+    def __call__(self, imgs):
+        """
+        :param imgs: list of [H,W,3] BGR uint8 images, or a single one
+        :return: (boxes [N,4] x1y1x2y2 in the original image, scores [N], labels [N]) numpy arrays for each image
+        """
+        if isinstance(imgs, np.ndarray) and imgs.ndim == 3:
+            imgs = [imgs]
+        inputs, ori_shapes = self.preprocess(imgs)
+        return self.postprocess(self.forward(inputs), ori_shapes)
+
+    @torch.no_grad()
+    def postprocess(self, preds, ori_shapes):
+        """
+        :param preds: output of forward
+        :param ori_shapes: [bz,2] output of preprocess
+        :return: (boxes, scores, labels) numpy arrays for each image, see __call__
+        """
+        bboxes, bboxvari = postprocess_boxes(preds, self.test_size, ori_shapes, self.cfg.MODEL.boxloss,
+                                             self.cfg.EVAL.varvote)
+        return [self._to_numpy(*result) for result in merge_views(self.cfg.EVAL, bboxes, variance=bboxvari)]
+
+    @torch.no_grad()
+    def detect_tiled(self, image):
+        """
+        Detect on overlapping tiles of a large image, EVAL.tile_batch tiles per forward. The boxes of all tiles(and of
+        the whole image with EVAL.tile_full) go back to image coordinates and the seams are merged by class-aware nms.
+        :param image: [H,W,3] BGR uint8 image or its path, see load_image. Only the tiles of the current batch are
+                    copied out of it, so a memory-mapped image is read lazily.
+        :return: (boxes [N,4], scores [N], labels [N]) numpy arrays
+        """
+        if isinstance(image, str):
+            image = load_image(image)
+        evalcfg = self.cfg.EVAL
+        tile_size = evalcfg.tile_size or self.test_size
+        h, w = image.shape[:2]
+        tiles = [(x, y) for y in tile_starts(h, tile_size, evalcfg.tile_overlap)
+                 for x in tile_starts(w, tile_size, evalcfg.tile_overlap)]
+        cand_boxes, cand_vari = [], []
+
+        def _collect(bboxes, bboxvari, offsets):
+            bboxes[..., :4] += offsets[:, None, :]
+            # only the boxes that can survive nms, the whole set of a 4k image does not fit
+            keep = bboxes[..., 4:].max(-1)[0] >= evalcfg.score_thres
+            cand_boxes.append(bboxes[keep])
+            if bboxvari is not None:
+                cand_vari.append(bboxvari[keep])
+
+        for start in range(0, len(tiles), evalcfg.tile_batch):
+            batch = tiles[start:start + evalcfg.tile_batch]
+            crops = [np.ascontiguousarray(image[y:y + tile_size, x:x + tile_size]) for x, y in batch]
+            bboxes, bboxvari = self._predict(crops)
+            offsets = bboxes.new_tensor([[x, y, x, y] for x, y in batch])
+            _collect(bboxes, bboxvari, offsets)
+        if evalcfg.tile_full and len(tiles) > 1:
+            bboxes, bboxvari = self._predict([np.ascontiguousarray(image)])
+            _collect(bboxes, bboxvari, bboxes.new_zeros((1, 4)))
+        bboxes = torch.cat(cand_boxes).unsqueeze(0)
+        bboxvari = torch.cat(cand_vari).unsqueeze(0) if cand_vari else None
+        return self._to_numpy(*torch_nms_batched(evalcfg, bboxes, variance=bboxvari)[0])
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import sys
+    import time
+    from yacscfg import _C as cfg
+
+    parser = argparse.ArgumentParser(description="Detector benchmark")
+    parser.add_argument("--config-file", default='configs/strongerv3.yaml')
+    # untrained heads keep most boxes and nms dominates, use a trained checkpoint or raise EVAL.score_thres
+    parser.add_argument("--ckpt", default=None)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=0, help="torch cpu threads, 0 keeps the default")
+    parser.add_argument("--no-fuse", action='store_true', help="keep the bn layers")
+    parser.add_argument("--tiled", default=None,
+                        help="benchmark detect_tiled on this .npy/image file, 'random' for a random 4k frame")
+    parser.add_argument("opts", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    detector = Detector(cfg, args.ckpt, fuse=not args.no_fuse)
+    if args.tiled is not None:
+        import tempfile
+        path = args.tiled
+        if path == 'random':
+            path = os.path.join(tempfile.mkdtemp(), 'frame.npy')
+            frame = cv2.resize(np.random.RandomState(0).randint(0, 255, (54, 96, 3), dtype=np.uint8), (3840, 2160))
+            np.save(path, frame)
+        start = time.time()
+        boxes, scores, labels = detector.detect_tiled(path)
+        image = load_image(path)
+        tile_size = cfg.EVAL.tile_size or cfg.EXPER.test_size
+        numtiles = len(tile_starts(image.shape[0], tile_size, cfg.EVAL.tile_overlap)) * \
+                   len(tile_starts(image.shape[1], tile_size, cfg.EVAL.tile_overlap))
+        print("tiled {}x{}: {} tiles of {} in {:.2f}s, {} boxes".format(image.shape[1], image.shape[0], numtiles,
+                                                                        tile_size, time.time() - start, len(boxes)))
+        sys.exit(0)
+    rng = np.random.RandomState(0)
+    # VOC-like image sizes
+    imgs = [rng.randint(0, 255, (rng.randint(300, 500), rng.randint(300, 500), 3), dtype=np.uint8)
+            for _ in range(args.batch_size)]
+    detector(imgs)
+    time_pre, time_total = 0.0, 0.0
+    for _ in range(args.iters):
+        start = time.time()
+        detector.preprocess(imgs)
+        time_pre += time.time() - start
+        start = time.time()
+        detector(imgs)
+        time_total += time.time() - start
+    print("{} test_size:{} batch:{} threads:{}".format(cfg.MODEL.modeltype, cfg.EXPER.test_size, args.batch_size,
+                                                       torch.get_num_threads()))
+    print("latency:{:.1f}ms/batch (preprocess {:.1f}ms) throughput:{:.2f}img/s".format(
+        time_total / args.iters * 1000, time_pre / args.iters * 1000, args.batch_size * args.iters / time_total))
@@ -88,6 +88,39 @@ def all_gather(data):
     return data_list
 
 
+def collective_device():
+    """
+    device of the tensors passed to the collectives, nccl only takes cuda tensors
+    """
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def all_gather_tensor(tensor):
+    """
+    all_gather for tensors whose first dimension differs across ranks
+    Returns:
+        the tensors of all ranks concatenated along the first dimension, on the input device
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return tensor
+    device = tensor.device
+    tensor = tensor.to(collective_device())
+    local_size = torch.LongTensor([tensor.shape[0]]).to(tensor.device)
+    size_list = [torch.LongTensor([0]).to(tensor.device) for _ in range(world_size)]
+    dist.all_gather(size_list, local_size)
+    size_list = [int(size.item()) for size in size_list]
+    max_size = max(size_list)
+
+    # pad to the same shape like all_gather
+    tensor_list = [tensor.new_zeros((max_size,) + tensor.shape[1:]) for _ in size_list]
+    padding = tensor.new_zeros((max_size - tensor.shape[0],) + tensor.shape[1:])
+    dist.all_gather(tensor_list, torch.cat((tensor, padding), dim=0))
+    return torch.cat([t[:size] for t, size in zip(tensor_list, size_list)], dim=0).to(device)
+
+
 def reduce_dict(input_dict, average=True):
     """
     Args:
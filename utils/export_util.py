@@ -0,0 +1,200 @@
+# coding: utf-8
+
+import torch
+import torch.nn as nn
+from torchvision.ops import batched_nms
+from utils.detector import postprocess_boxes
+
+
+class ExportModel(nn.Module):
+    """
+    Model, decoding, letterbox inversion and hard nms as a single traceable graph with a dynamic batch size.
+    Images go in letterboxed to test_size, the detections come out padded to max_det per image.
+    """
+
+    def __init__(self, model, cfg, max_det=100, pre_nms_topk=3000):
+        """
+        :param model: StrongerV3/StrongerV1(pruned or US-sliced) in eval mode
+        :param cfg: the full yacs config, uses MODEL.boxloss, EXPER.test_size and EVAL.score_thres/nms_iou
+        :param pre_nms_topk: candidates kept per image before nms
+        """
+        super().__init__()
+        self.model = model
+        self.boxloss = cfg.MODEL.boxloss
+        self.test_size = cfg.EXPER.test_size
+        self.score_thres = cfg.EVAL.score_thres
+        self.nms_iou = cfg.EVAL.nms_iou
+        self.max_det = max_det
+        self.pre_nms_topk = pre_nms_topk
+
+    def forward(self, input, ori_shapes):
+        """
+        :param input: [bz,3,test_size,test_size] letterboxed rgb image in [0,1]
+        :param ori_shapes: [bz,2] (h,w) of the original images
+        :return: boxes [bz,max_det,4] x1y1x2y2 in the original image, scores [bz,max_det], labels [bz,max_det],
+                num_dets [bz], the padded detections have score 0 and label -1
+        """
+        preds = self.model(input)
+        bboxes, _ = postprocess_boxes(preds, self.test_size, ori_shapes, self.boxloss)
+        bz, numcls = bboxes.shape[0], bboxes.shape[-1] - 4
+        scores = bboxes[..., 4:].reshape(bz, -1)
+        topk_scores, topk_idx = scores.topk(min(self.pre_nms_topk, scores.shape[1]), dim=1)
+        box_idx = topk_idx // numcls
+        cand_boxes = torch.gather(bboxes[..., :4], 1, box_idx.unsqueeze(-1).expand(-1, -1, 4)).reshape(-1, 4)
+        cand_labels = (topk_idx % numcls).reshape(-1)
+        cand_img = torch.arange(bz, device=input.device).unsqueeze(1).expand_as(topk_idx).reshape(-1)
+        cand_scores = topk_scores.reshape(-1)
+        valid = (cand_scores >= self.score_thres).nonzero().squeeze(1)
+        cand_boxes, cand_scores = cand_boxes[valid], cand_scores[valid]
+        cand_labels, cand_img = cand_labels[valid], cand_img[valid]
+        keep = batched_nms(cand_boxes, cand_scores, cand_img * numcls + cand_labels, self.nms_iou)
+        # keep is sorted by score, the rank of a box inside its image is its slot in the padded output
+        img = cand_img[keep]
+        onehot = (img.unsqueeze(1) == torch.arange(bz, device=input.device).unsqueeze(0)).long()
+        rank = (onehot.cumsum(0) * onehot).sum(1) - 1
+        slot = (rank < self.max_det).nonzero().squeeze(1)
+        keep, dst = keep[slot], img[slot] * self.max_det + rank[slot]
+        out_boxes = cand_boxes.new_zeros((bz * self.max_det, 4))
+        out_scores = cand_scores.new_zeros((bz * self.max_det,))
+        out_labels = cand_labels.new_full((bz * self.max_det,), -1)
+        out_boxes[dst] = cand_boxes[keep]
+        out_scores[dst] = cand_scores[keep]
+        out_labels[dst] = cand_labels[keep]
+        num_dets = torch.clamp(onehot.sum(0), max=self.max_det)
+        return (out_boxes.view(bz, self.max_det, 4), out_scores.view(bz, self.max_det),
+                out_labels.view(bz, self.max_det), num_dets)
+
+
+def resize_to_state_dict(model, state_dict):
+    """
+    Load a checkpoint whose conv/bn layers have fewer channels than the model built from the config(a pruned model),
+    the layers take the shapes of the checkpoint and the depthwise convs follow their new channel count.
+    """
+    modules = dict(model.named_modules())
+    for k, v in state_dict.items():
+        modulename, _, attr = k.rpartition('.')
+        module = modules[modulename]
+        old = getattr(module, attr)
+        if old is None or old.shape == v.shape:
+            continue
+        if isinstance(old, nn.Parameter):
+            old.data = v.clone()
+        else:
+            setattr(module, attr, v.clone())
+        if isinstance(module, nn.Conv2d) and attr == 'weight' and module.groups > 1 and v.shape[1] == 1:
+            module.groups = v.shape[0]
+    model.load_state_dict(state_dict, strict=True)
+
+
+def export_model(exportmodel, batch_size=1, output='model.pt', format='torchscript', opset=17):
+    """
+    Trace the model with a dummy batch, the batch dimension stays dynamic.
+    """
+    test_size = exportmodel.test_size
+    input = torch.rand(batch_size, 3, test_size, test_size)
+    ori_shapes = torch.tensor([[test_size * 0.75, test_size]] * batch_size)
+    with torch.no_grad():
+        if format == 'torchscript':
+            traced = torch.jit.trace(exportmodel, (input, ori_shapes), check_trace=False)
+            traced.save(output)
+        elif format == 'onnx':
+            torch.onnx.export(exportmodel, (input, ori_shapes), output, opset_version=opset, dynamo=False,
+                              input_names=['input', 'ori_shapes'],
+                              output_names=['boxes', 'scores', 'labels', 'num_dets'],
+                              dynamic_axes={name: {0: 'batch'} for name in
+                                            ['input', 'ori_shapes', 'boxes', 'scores', 'labels', 'num_dets']})
+        else:
+            raise NotImplementedError(format)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    import models
+    from yacscfg import _C as cfg
+    from utils.fuse_util import fuse_model
+    from utils.nms_utils import torch_nms_batched
+    from utils.util import match_state_dict
+    from utils.ckpt_util import load_ckpt_file
+
+    parser = argparse.ArgumentParser(description="TorchScript/ONNX export")
+    parser.add_argument("--config-file", default='configs/strongerv3.yaml')
+    parser.add_argument("--ckpt", default=None)
+    parser.add_argument("--pruned", action='store_true', help="the checkpoint holds a pruned model")
+    parser.add_argument("--width-mult", type=float, default=1.0, help="width of the US models")
+    parser.add_argument("--format", default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--max-det", type=int, default=100)
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--score-tol", type=float, default=1e-5, help="max score difference of the parity check")
+    parser.add_argument("--box-tol", type=float, default=1e-2, help="max box difference(pixels) of the parity check")
+    parser.add_argument("opts", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.MODEL.backbone_pretrained = ''
+    cfg.freeze()
+
+    model = getattr(models, cfg.MODEL.modeltype)(cfg=cfg.MODEL)
+    if args.ckpt is not None:
+        state_dict = load_ckpt_file(args.ckpt)
+        state_dict = state_dict.get('state_dict', state_dict)
+        state_dict = {k[7:] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+        if args.pruned:
+            resize_to_state_dict(model, state_dict)
+        else:
+            model.load_state_dict(match_state_dict(model.state_dict(), state_dict), strict=True)
+    model.apply(lambda m: setattr(m, 'width_mult', args.width_mult))
+    fuse_model(model.eval())
+    exportmodel = ExportModel(model, cfg, max_det=args.max_det).eval()
+    output = args.output or '{}.{}'.format(cfg.EXPER.experiment_name or cfg.MODEL.modeltype,
+                                           'pt' if args.format == 'torchscript' else 'onnx')
+    export_model(exportmodel, batch_size=2, output=output, format=args.format)
+    print("exported {}".format(output))
+
+    # parity with the eager model and torch_nms_batched on another batch size
+    if args.format == 'torchscript':
+        exported = torch.jit.load(output)
+    else:
+        import onnxruntime
+        session = onnxruntime.InferenceSession(output, providers=['CPUExecutionProvider'])
+        exported = lambda input, ori_shapes: [torch.from_numpy(o) for o in session.run(
+            None, {'input': input.numpy(), 'ori_shapes': ori_shapes.numpy()})]
+    torch.manual_seed(0)
+    bz = 3
+    # smooth random images, pixel noise gives the same prediction on most grids and the nms order is all ties
+    input = torch.nn.functional.interpolate(torch.rand(bz, 3, 8, 8), size=cfg.EXPER.test_size, mode='bilinear')
+    ori_shapes = torch.tensor([[375., 500.], [500., 333.], [cfg.EXPER.test_size, cfg.EXPER.test_size]])
+    nmscfg = cfg.EVAL.clone()
+    nmscfg.defrost()
+    nmscfg.soft = False
+    with torch.no_grad():
+        boxes, scores, labels, num_dets = exported(input, ori_shapes)
+        bboxes, _ = postprocess_boxes(model(input), cfg.EXPER.test_size, ori_shapes, cfg.MODEL.boxloss)
+        for i, (b, s, l) in enumerate(torch_nms_batched(nmscfg, bboxes)):
+            num = int(num_dets[i])
+            if b is None:
+                assert num == 0
+                continue
+            # boxes of equal score come out in any order, match each exported box to the eager boxes of its score
+            topscores = torch.sort(s, descending=True)[0][:args.max_det]
+            # onnxruntime convs round differently, scores within score_tol count as equal
+            same = ((scores[i, :num, None] - s[None, :]).abs() <= args.score_tol) & \
+                   (labels[i, :num, None].long() == l[None, :].long())
+            boxdiff = (boxes[i, :num, None, :] - b[None, :, :]).abs().max(-1)[0]
+            boxdiff = torch.where(same, boxdiff, torch.full_like(boxdiff, float('inf'))).min(1)[0]
+            scorediff = (topscores[:num] - scores[i, :num]).abs().max().item() if num else 0.0
+            boxdiff = boxdiff.max().item() if num else 0.0
+            print("image {}: {}/{} dets, max score diff:{:.2e} max box diff:{:.2e}".format(
+                i, num, len(s), scorediff, boxdiff))
+            assert num == len(topscores), "image {}: {} exported dets, {} eager".format(i, num, len(topscores))
+            assert scorediff <= args.score_tol, "image {}: score diff {:.2e}".format(i, scorediff)
+            assert boxdiff <= args.box_tol, "image {}: box diff {:.2e}".format(i, boxdiff)
+        for name, fn in (('eager', lambda: torch_nms_batched(nmscfg, postprocess_boxes(
+                model(input), cfg.EXPER.test_size, ori_shapes, cfg.MODEL.boxloss)[0])),
+                         (args.format, lambda: exported(input, ori_shapes))):
+            fn()
+            start = time.time()
+            for _ in range(args.iters):
+                fn()
+            print("{} {:.1f}ms/batch of {}".format(name, (time.time() - start) / args.iters * 1000, bz))
@@ -0,0 +1,86 @@
+# coding: utf-8
+
+import torch
+import torch.nn as nn
+
+
+def fuse_conv_bn(conv, bn):
+    """
+    :return: Conv2d with bias computing bn(conv(x)) with the running statistics of bn
+    """
+    # pruned convs keep their original in/out_channels, only the weights and groups are cut, so go by the weight shape
+    weight = conv.weight.detach()
+    fused = nn.Conv2d(weight.shape[1] * conv.groups, weight.shape[0], conv.kernel_size, conv.stride, conv.padding,
+                      conv.dilation, conv.groups, bias=True, padding_mode=conv.padding_mode)
+    fused = fused.to(weight.device)
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias.detach() if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.weight.data = weight * scale.view(-1, 1, 1, 1)
+    fused.bias.data = bn.bias.detach() + (bias - bn.running_mean) * scale
+    return fused
+
+
+def fuse_model(model):
+    """
+    Fold every BatchNorm2d into the Conv2d right before it, inplace. Covers conv_bn, sepconv_bn, InvertedResidual
+    and DarknetBlock(and pruned copies of them), the US blocks keep their bn since they slice channels at run time.
+    The bn is replaced by nn.Identity so the conv keeps its name in the state dict, the model is for inference only.
+    :return: the model
+    """
+    assert not model.training, "bn folding uses the running statistics, call model.eval() first"
+    for seq in model.modules():
+        if not isinstance(seq, nn.Sequential):
+            continue
+        names = list(seq._modules.keys())
+        for name, nextname in zip(names[:-1], names[1:]):
+            conv, bn = seq._modules[name], seq._modules[nextname]
+            if type(conv) is nn.Conv2d and type(bn) is nn.BatchNorm2d:
+                seq._modules[name] = fuse_conv_bn(conv, bn)
+                seq._modules[nextname] = nn.Identity()
+    return model
+
+
+if __name__ == '__main__':
+    import argparse
+    import copy
+    import time
+    import models
+    from yacscfg import _C as cfg
+
+    parser = argparse.ArgumentParser(description="Conv-BN folding parity and latency")
+    parser.add_argument("--config-file", default='configs/strongerv3.yaml')
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("opts", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.MODEL.backbone_pretrained = ''
+    cfg.freeze()
+
+    torch.manual_seed(0)
+    model = getattr(models, cfg.MODEL.modeltype)(cfg=cfg.MODEL)
+    # random running statistics, the initial ones make every bn close to identity
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.0)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.5, 0.5)
+    model.eval()
+    fused = fuse_model(copy.deepcopy(model))
+    numbn = sum(isinstance(m, nn.BatchNorm2d) for m in model.modules())
+    numleft = sum(isinstance(m, nn.BatchNorm2d) for m in fused.modules())
+    inp = torch.rand(args.batch_size, 3, cfg.EXPER.test_size, cfg.EXPER.test_size)
+
+    with torch.no_grad():
+        out, out_fused = model(inp), fused(inp)
+        print("folded {}/{} bn, max abs diff:{:.2e} max rel diff:{:.2e}".format(
+            numbn - numleft, numbn, (out - out_fused).abs().max().item(),
+            ((out - out_fused).abs() / out.abs().clamp(min=1e-3)).max().item()))
+        for name, net in (('eager', model), ('fused', fused)):
+            net(inp)
+            start = time.time()
+            for _ in range(args.iters):
+                net(inp)
+            print("{} {:.1f}ms/batch".format(name, (time.time() - start) / args.iters * 1000))
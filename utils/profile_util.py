@@ -0,0 +1,126 @@
+# coding: utf-8
+
+import time
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
+import torch
+
+
+class StepProfiler(object):
+    """
+    Wall time of each phase of a training step, nested phases are excluded from their parent.
+    Also measures the time spent waiting for the dataloader and the images per second.
+    A disabled profiler only costs a function call per phase.
+    """
+
+    def __init__(self, enabled=False, sync=True):
+        """
+        :param sync: synchronize cuda around each phase, otherwise the time of the async kernels lands on the
+                    phase that waits for them(usually the .item() of the losses)
+        """
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.trace = None
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict()
+        self.numstep = 0
+        self.numimg = 0
+        self.step_time = 0.0
+        self.wait_time = 0.0
+        self._stack = []
+        self._step_end = None
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = self._now() - start
+            children = self._stack.pop()
+            self.times[name] = self.times.get(name, 0.0) + elapsed - children
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def instrument(self, model, names=('loss', 'build_target')):
+        """
+        time the methods of the model as phases of their own, so the forward phase only keeps the network
+        """
+        model = getattr(model, 'module', model)
+        for name in names:
+            method = getattr(model, name)
+
+            def timed(*args, _method=method, _name=name, **kwargs):
+                with self.phase(_name):
+                    return _method(*args, **kwargs)
+
+            setattr(model, name, functools.wraps(method)(timed))
+
+    def start_epoch(self):
+        """
+        call before the first batch of an epoch, so the validation/checkpoint time between epochs is not booked as
+        waiting for data
+        """
+        self._step_end = None
+
+    def start_step(self):
+        """
+        call once the batch is out of the dataloader
+        """
+        if not self.enabled:
+            return
+        now = self._now()
+        if self._step_end is not None:
+            self.wait_time += now - self._step_end
+            self.times['data'] = self.times.get('data', 0.0) + now - self._step_end
+        self._step_start = now
+
+    def end_step(self, numimg):
+        if not self.enabled:
+            return
+        self._step_end = self._now()
+        self.step_time += self._step_end - self._step_start
+        self.numstep += 1
+        self.numimg += numimg
+        if self.trace is not None:
+            self.trace.step()
+
+    def start_trace(self, logdir, steps, wait=5, warmup=2):
+        """
+        record a torch.profiler trace of steps training steps after wait+warmup steps, viewable in tensorboard
+        """
+        self.trace = torch.profiler.profile(
+            schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(logdir),
+            record_shapes=True)
+        self.trace.start()
+
+    def stop_trace(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+    def summary(self):
+        """
+        :return: ms per step of each phase, img_per_sec and loader_starvation(share of the time waiting for data)
+        """
+        if self.numstep == 0:
+            return OrderedDict()
+        result = OrderedDict((k + '_ms', v / self.numstep * 1000) for k, v in self.times.items())
+        total = self.step_time + self.wait_time
+        result['step_ms'] = self.step_time / self.numstep * 1000
+        result['img_per_sec'] = self.numimg / total if total > 0 else 0.0
+        result['loader_starvation'] = self.wait_time / total if total > 0 else 0.0
+        return result
@@ -0,0 +1,154 @@
+# coding: utf-8
+
+import torch
+import torch.nn as nn
+import torch.ao.nn.intrinsic as nni
+from torch.ao import quantization
+from utils.fuse_util import fuse_model
+
+# outputs of the StrongerV3 blocks quantized as a whole, the last conv of each det head stays in float
+QUANT_BLOCKS = ('headslarge', 'headsmid', 'headsmall', 'mergelarge', 'mergemid')
+QUANT_DET_BLOCKS = ('detlarge.conv5', 'detmid.conv13', 'detsmall.conv21')
+
+
+class QuantBackbone(nn.Module):
+    """
+    Quantize the input of the backbone and dequantize each of its outputs.
+    """
+
+    def __init__(self, backbone):
+        super().__init__()
+        self.backbone_outchannels = backbone.backbone_outchannels
+        self.quant = quantization.QuantStub()
+        self.body = backbone
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, x):
+        return [self.dequant(out) for out in self.body(self.quant(x))]
+
+
+def get_qconfig(backend='x86', per_channel=True):
+    """
+    :param backend: quantized engine, x86/fbgemm for servers, qnnpack for arm
+    """
+    qconfig = quantization.get_default_qconfig(backend)
+    if not per_channel:
+        qconfig = qconfig._replace(weight=quantization.default_weight_observer)
+    return qconfig
+
+
+def get_relu6_qconfig(qconfig, backend='x86'):
+    """
+    conv+relu6 runs as conv+relu with the output range fixed to [0,6], the int8 clamp does the relu6
+    """
+    # fbgemm keeps a bit of headroom on the activations, see reduce_range of the default qconfig
+    quant_max = 127 if backend in ('x86', 'fbgemm') else 255
+    activation = quantization.FixedQParamsObserver.with_args(scale=6.0 / quant_max, zero_point=0,
+                                                             dtype=torch.quint8, quant_min=0, quant_max=quant_max)
+    return qconfig._replace(activation=activation)
+
+
+def fuse_relu6(model, qconfig):
+    """
+    Replace conv(+folded bn)+ReLU6 with ConvReLU2d carrying the fixed [0,6] output qconfig, inplace.
+    """
+    for seq in model.modules():
+        if not isinstance(seq, nn.Sequential):
+            continue
+        names = [name for name, m in seq.named_children() if not isinstance(m, nn.Identity)]
+        for name, nextname in zip(names[:-1], names[1:]):
+            conv, relu = seq._modules[name], seq._modules[nextname]
+            if type(conv) is nn.Conv2d and type(relu) is nn.ReLU6:
+                fused = nni.ConvReLU2d(conv, nn.ReLU())
+                fused.qconfig = qconfig
+                seq._modules[name] = fused
+                seq._modules[nextname] = nn.Identity()
+    return model
+
+
+def quantize_model(model, calib_batches, backend='x86', per_channel=True, relu6_fusion=True):
+    """
+    Post-training static int8 quantization of StrongerV3 on cpu, inplace.
+    The backbone, heads and merges run in int8, concat/decode_infer/nms and the last conv of each det head in float.
+    :param calib_batches: iterable of input images [bz,3,H,W] to calibrate the observers
+    :return: the quantized model
+    """
+    assert type(model).__name__ == 'StrongerV3' and not model.cfg.ASFF, "only StrongerV3 without ASFF is supported"
+    torch.backends.quantized.engine = backend
+    qconfig = get_qconfig(backend, per_channel)
+    model.cpu().eval()
+    fuse_model(model)
+    model.backbone = QuantBackbone(model.backbone)
+    for name in QUANT_BLOCKS:
+        setattr(model, name, quantization.QuantWrapper(getattr(model, name)))
+    for name in QUANT_DET_BLOCKS:
+        det, conv = name.split('.')
+        setattr(getattr(model, det), conv, quantization.QuantWrapper(getattr(getattr(model, det), conv)))
+    if relu6_fusion:
+        fuse_relu6(model, get_relu6_qconfig(qconfig, backend))
+    model.backbone.qconfig = qconfig
+    for name in QUANT_BLOCKS + QUANT_DET_BLOCKS:
+        model.get_submodule(name).qconfig = qconfig
+    quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for imgs in calib_batches:
+            model(imgs)
+    quantization.convert(model, inplace=True)
+    return model
+
+
+if __name__ == '__main__':
+    import argparse
+    import copy
+    import itertools
+    import time
+    import models
+    from trainers import *
+    from yacscfg import _C as cfg
+    from utils.util import match_state_dict
+    from utils.ckpt_util import load_ckpt_file
+
+    parser = argparse.ArgumentParser(description="int8 post-training quantization")
+    parser.add_argument("--config-file", default='configs/strongerv3.yaml')
+    parser.add_argument("--ckpt", default=None)
+    parser.add_argument("--backend", default='x86', choices=['x86', 'fbgemm', 'qnnpack'])
+    parser.add_argument("--no-per-channel", action='store_true', help="per-tensor weight quantization")
+    parser.add_argument("--no-relu6-fusion", action='store_true', help="keep relu6 as a separate quantized op")
+    parser.add_argument("--calib-batches", type=int, default=20)
+    parser.add_argument("--valid-iter", type=int, default=-1, help="batches to evaluate, -1 for the whole set")
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("opts", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.MODEL.backbone_pretrained = ''
+    cfg.do_test = True
+    cfg.freeze()
+
+    model = getattr(models, cfg.MODEL.modeltype)(cfg=cfg.MODEL)
+    if args.ckpt is not None:
+        state_dict = load_ckpt_file(args.ckpt)
+        state_dict = state_dict.get('state_dict', state_dict)
+        model.load_state_dict(match_state_dict(model.state_dict(), state_dict), strict=True)
+    # the trainer only provides the dataloaders and the evaluator
+    trainer = eval('Trainer_{}'.format(cfg.DATASET.dataset))(args=cfg, model=model, optimizer=None, lrscheduler=None)
+    trainer.device = torch.device('cpu')
+    floatmodel = fuse_model(model.eval())
+    calib_batches = (inputs[0] for inputs in itertools.islice(trainer.train_dataloader, args.calib_batches))
+    qmodel = quantize_model(copy.deepcopy(floatmodel), calib_batches, args.backend, not args.no_per_channel,
+                            not args.no_relu6_fusion)
+
+    inp = torch.rand(1, 3, cfg.EXPER.test_size, cfg.EXPER.test_size)
+    results = {}
+    for name, net in (('float', floatmodel), ('int8', qmodel)):
+        with torch.no_grad():
+            net(inp)
+            start = time.time()
+            for _ in range(args.iters):
+                net(inp)
+        latency = (time.time() - start) / args.iters * 1000
+        trainer.model = net
+        results[name] = trainer._valid_epoch(validiter=args.valid_iter)[0]
+        trainer._reset_loggers()
+        print("{}: {:.1f}ms/img {}:{:.4f}".format(name, latency, trainer.logger_custom[0], results[name][0]))
+    print("{} delta: {:+.4f}".format(trainer.logger_custom[0], results['int8'][0] - results['float'][0]))
@@ -0,0 +1,216 @@
+# coding: utf-8
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import torch
+from utils.bench_util import summarize
+from utils.util import BackgroundWorker
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def read_frames(source):
+    """
+    :param source: video file(or any url cv2.VideoCapture opens) or a directory of images read in name order
+    :return: generator of BGR frames
+    """
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if os.path.splitext(name)[1].lower() in IMG_EXTENSIONS:
+                frame = cv2.imread(os.path.join(source, name), cv2.IMREAD_COLOR)
+                if frame is not None:
+                    yield frame
+        return
+    cap = cv2.VideoCapture(source)
+    assert cap.isOpened(), "cannot open {}".format(source)
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        cap.release()
+
+
+class StreamDetector(object):
+    """
+    Frame stream inference: decode thread -> preprocess pool -> batched forward -> postprocess/sink thread.
+    At most max_in_flight frames are between decoding and the sink. Once the limit is reached the decode thread
+    waits('block', every frame gets detected) or skips the frame('drop', for live sources).
+    The forward batches whatever frames are ready, up to batch_size, so batches only fill up when the model lags.
+    """
+
+    def __init__(self, detector, batch_size=4, max_in_flight=16, policy='block', num_preprocess=2):
+        """
+        :param detector: utils.detector.Detector, its preprocess, forward and postprocess(with nms) are the stages
+        """
+        assert policy in ('block', 'drop'), policy
+        assert max_in_flight >= batch_size
+        self.detector = detector
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.policy = policy
+        self.num_preprocess = num_preprocess
+
+    def _preprocess(self, frame):
+        start = time.perf_counter()
+        inputs, ori_shapes = self.detector.preprocess([frame])
+        return inputs, ori_shapes, time.perf_counter() - start
+
+    def run(self, source, sink=None, max_frames=-1):
+        """
+        :param sink: fn(index, frame, (boxes, scores, labels)) called in frame order on the postprocess thread
+        :param max_frames: stop after this many decoded frames, -1 for the whole source
+        :return: dict of frame counts, fps and the latency summary of each stage(see bench_util.summarize)
+        """
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        # every queued frame holds a slot, +1 for the end sentinel
+        pending = queue.Queue(maxsize=self.max_in_flight + 1)
+        # set once the stream stops early, the decode thread returns at the next frame or acquire poll
+        stop = threading.Event()
+        times = {'decode': [], 'preprocess': [], 'forward': [], 'postprocess': [], 'latency': []}
+        counts = {'frames': 0, 'dropped': 0, 'batches': 0}
+        decode_error, post_error = [], []
+        pool = ThreadPoolExecutor(self.num_preprocess)
+
+        def _decode():
+            try:
+                frames = read_frames(source)
+                while not stop.is_set() and (max_frames < 0 or counts['frames'] + counts['dropped'] < max_frames):
+                    start = time.perf_counter()
+                    frame = next(frames, None)
+                    if frame is None:
+                        break
+                    times['decode'].append(time.perf_counter() - start)
+                    # index in the source, dropped frames leave a gap
+                    index = counts['frames'] + counts['dropped']
+                    if self.policy == 'block':
+                        while not in_flight.acquire(timeout=0.1):
+                            if stop.is_set():
+                                return
+                    elif not in_flight.acquire(blocking=False):
+                        counts['dropped'] += 1
+                        continue
+                    pending.put((index, frame, start, pool.submit(self._preprocess, frame)))
+                    counts['frames'] += 1
+            except BaseException as e:
+                decode_error.append(e)
+            finally:
+                pending.put(None)
+
+        def _postprocess(batch, preds, ori_shapes):
+            try:
+                # the batches after a failure are skipped, only their slots are freed
+                if post_error:
+                    return
+                start = time.perf_counter()
+                results = self.detector.postprocess(preds, ori_shapes)
+                times['postprocess'].append(time.perf_counter() - start)
+                for (index, frame, decoded, _), result in zip(batch, results):
+                    if sink is not None:
+                        sink(index, frame, result)
+                    times['latency'].append(time.perf_counter() - decoded)
+            except BaseException as e:
+                post_error.append(e)
+                stop.set()
+            finally:
+                for _ in batch:
+                    in_flight.release()
+
+        start = time.perf_counter()
+        decoder = threading.Thread(target=_decode, name='stream_decode', daemon=True)
+        decoder.start()
+        post = BackgroundWorker(_postprocess, maxsize=2, name='stream_postprocess')
+        done = False
+        try:
+            while not done and not stop.is_set():
+                item = pending.get()
+                if item is None:
+                    break
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    try:
+                        item = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        done = True
+                        break
+                    batch.append(item)
+                prepared = [future.result() for _, _, _, future in batch]
+                times['preprocess'].extend(t for _, _, t in prepared)
+                inputs = torch.cat([inp for inp, _, _ in prepared])
+                ori_shapes = torch.cat([shape for _, shape, _ in prepared])
+                forward_start = time.perf_counter()
+                preds = self.detector.forward(inputs)
+                times['forward'].append(time.perf_counter() - forward_start)
+                counts['batches'] += 1
+                post.submit(batch, preds, ori_shapes)
+        finally:
+            stop.set()
+            post.join()
+            pool.shutdown()
+            decoder.join()
+        if post_error:
+            raise post_error[0]
+        if decode_error:
+            raise decode_error[0]
+        elapsed = time.perf_counter() - start
+        stats = dict(counts, fps=counts['frames'] / elapsed, mean_batch=counts['frames'] / max(counts['batches'], 1))
+        stats.update({k: summarize(v) for k, v in times.items() if v})
+        return stats
+
+
+if __name__ == '__main__':
+    import argparse
+    from yacscfg import _C as cfg
+    from utils.detector import Detector
+    from utils.visualize import visualize_boxes
+
+    parser = argparse.ArgumentParser(description="video/image sequence inference")
+    parser.add_argument("--source", required=True, help="video file or directory of images")
+    parser.add_argument("--config-file", default='configs/strongerv3.yaml')
+    parser.add_argument("--ckpt", default=None)
+    parser.add_argument("--output", default=None, help="video file to write the detections to")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-in-flight", type=int, default=16)
+    parser.add_argument("--policy", default='block', choices=['block', 'drop'])
+    parser.add_argument("--preprocess-workers", type=int, default=2)
+    parser.add_argument("--max-frames", type=int, default=-1)
+    parser.add_argument("--fps", type=float, default=25.0, help="frame rate of the output video")
+    parser.add_argument("opts", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    detector = Detector(cfg, args.ckpt)
+    writer = []
+
+    def sink(index, frame, result):
+        if args.output is None:
+            return
+        boxes, scores, labels = result
+        image = np.ascontiguousarray(frame[..., ::-1])
+        image = visualize_boxes(image=image, boxes=boxes, labels=labels, probs=scores, class_labels=cfg.MODEL.LABEL)
+        if not writer:
+            writer.append(cv2.VideoWriter(args.output, cv2.VideoWriter_fourcc(*'mp4v'), args.fps,
+                                          (frame.shape[1], frame.shape[0])))
+        writer[0].write(image[..., ::-1])
+
+    stream = StreamDetector(detector, args.batch_size, args.max_in_flight, args.policy, args.preprocess_workers)
+    stats = stream.run(args.source, sink, args.max_frames)
+    if writer:
+        writer[0].release()
+    print("{frames} frames({dropped} dropped) in {batches} batches, {fps:.1f} fps, mean batch {mean_batch:.1f}".format(
+        **stats))
+    for stage in ('decode', 'preprocess', 'forward', 'postprocess', 'latency'):
+        if stage in stats:
+            print("{}: mean {mean_ms:.1f}ms p50 {p50_ms:.1f}ms p90 {p90_ms:.1f}ms p99 {p99_ms:.1f}ms".format(
+                stage, **stats[stage]))
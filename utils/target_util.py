@@ -0,0 +1,80 @@
+# coding: utf-8
+
+import torch
+
+
+def assign_yolo_target(bboxs: list, input_size, numclass, gt_per_grid, strides=(8, 16, 32),
+                       reg_area_limit=(0, 30, 90, 10000), delta=0.01):
+    """
+    Assign gt boxes to grids for the whole batch without looping over boxes.
+    Each gt goes to the level whose area range holds sqrt(w*h) and to the grid holding its center. The first gt of a
+    grid fills all gt_per_grid slots, the n-th gt takes slot n and every gt beyond the last slot overwrites it.
+    :param bboxs: gtbox,label and mixup weight for each image, [bz,[N,6]]
+    :param input_size: size of the (square) input image
+    :return: index of the assigned anchors in the flattened batch [K] and their targets [K,6+numclass],
+            (x1y1x2y2,respond,mixweight,smoothed class prob)
+    """
+    bz = len(bboxs)
+    device = bboxs[0].device
+    gridsizes = [input_size // s for s in strides]
+    grid_offsets = [sum(g * g for g in gridsizes[:i]) for i in range(len(gridsizes))]
+    numgrid = sum(g * g for g in gridsizes)
+    gt = torch.cat(bboxs, 0)
+    img_idx = torch.repeat_interleave(torch.arange(bz, device=device),
+                                      torch.tensor([b.shape[0] for b in bboxs], device=device))
+    bbox, class_label, mix_weight = gt.split([4, 1, 1], dim=1)
+    class_label = class_label.long().squeeze(1)
+    bbox_xywh = torch.cat([(bbox[:, 2:] + bbox[:, :2]) * 0.5,
+                           bbox[:, 2:] - bbox[:, :2]], dim=-1)
+    bboxarea = torch.sqrt(bbox_xywh[:, -2] * bbox_xywh[:, -1])
+    grid_idx = torch.full_like(img_idx, -1)
+    for i in range(len(strides)):
+        valid_mask = (bboxarea > reg_area_limit[i]) & (bboxarea < reg_area_limit[i + 1])
+        gt_xy = (bbox_xywh[valid_mask, :2] / strides[i]).long()
+        # negative grids wrap around like python indexing
+        gt_xy = torch.where(gt_xy < 0, gt_xy + gridsizes[i], gt_xy)
+        grid_idx[valid_mask] = grid_offsets[i] + gt_xy[:, 1] * gridsizes[i] + gt_xy[:, 0]
+    assigned = (grid_idx >= 0).nonzero().squeeze(1)
+    if assigned.numel() == 0:
+        return assigned, torch.zeros(0, 6 + numclass, device=device)
+
+    # group gts by grid, the stable sort keeps their order inside a grid
+    key, order = torch.sort(img_idx[assigned] * numgrid + grid_idx[assigned], stable=True)
+    gt_sorted = assigned[order]
+    grid_key, counts = torch.unique_consecutive(key, return_counts=True)
+    starts = torch.cumsum(counts, 0) - counts
+    # the gt left in each slot: slot n keeps the n-th gt if there is one, otherwise the first gt,
+    # the last slot keeps the last gt once the grid is full
+    slot = torch.arange(gt_per_grid, device=device)
+    rank = torch.where(slot[None, :] < counts[:, None], slot[None, :], torch.zeros_like(slot[None, :]))
+    rank[:, -1] = torch.where(counts >= gt_per_grid, counts - 1, torch.zeros_like(counts))
+    winner = gt_sorted[starts[:, None] + rank]
+
+    gt_target = torch.full((gt.shape[0], 6 + numclass), 1.0 / numclass * delta, device=device)
+    gt_target[:, :4] = bbox
+    gt_target[:, 4] = 1.0
+    gt_target[:, 5] = mix_weight[:, 0]
+    gt_target[torch.arange(gt.shape[0], device=device), 6 + class_label] = (1.0 - delta) + 1.0 / numclass * delta
+    anchor_idx = grid_key[:, None] * gt_per_grid + slot[None, :]
+    return anchor_idx.view(-1), gt_target[winner].view(-1, 6 + numclass)
+
+
+def dense_yolo_target(anchor_idx, anchor_target, bz, numanchor):
+    """
+    :param anchor_idx: [K] and anchor_target [K,6+numclass], output of assign_yolo_target
+    :return: [bz,numanchor,6+numclass], the unassigned anchors get zeros and mixweight 1
+    """
+    target = anchor_target.new_zeros(bz * numanchor, anchor_target.shape[-1])
+    # initialize box weight 1
+    target[:, 5] = 1.0
+    target[anchor_idx] = anchor_target
+    return target.view(bz, numanchor, -1)
+
+
+def build_yolo_target(bboxs: list, input_size, numclass, gt_per_grid, strides=(8, 16, 32)):
+    """
+    :return: [bz,num_grids*gt_per_grid,6+numclass], dense version of assign_yolo_target
+    """
+    numanchor = sum((input_size // s) ** 2 for s in strides) * gt_per_grid
+    anchor_idx, anchor_target = assign_yolo_target(bboxs, input_size, numclass, gt_per_grid, strides)
+    return dense_yolo_target(anchor_idx, anchor_target, len(bboxs), numanchor)
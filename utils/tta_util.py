@@ -0,0 +1,105 @@
+# coding: utf-8
+
+import torch
+import torch.nn.functional as F
+from models.backbone.baseblock import InputNorm
+from utils.nms_utils import torch_nms_batched, torch_wbf_batched
+
+
+def tta_enabled(evalcfg):
+    return len(evalcfg.tta_scales) > 0 or evalcfg.tta_flip
+
+
+def tta_numviews(evalcfg):
+    return max(len(evalcfg.tta_scales), 1) * (2 if evalcfg.tta_flip else 1)
+
+
+def tta_forward(model, imgs, scales, flip=False, boxloss='iou'):
+    """
+    One forward per scale with the flipped images in the same batch, the boxes are un-flipped and mapped back to
+    the input size so every view can go through postprocess_boxes with the input size.
+    :param imgs: [bz,3,S,S] letterboxed input, float in [0,1] or uint8
+    :param scales: input sizes of the views(multiples of 32), empty for S only
+    :return: [bz,numviews*N,C] decoded predictions of all views
+    """
+    imgs = InputNorm()(imgs)
+    bz, size = imgs.shape[0], imgs.shape[-1]
+    if flip:
+        imgs = torch.cat([imgs, imgs.flip(-1)], 0)
+    outputs = []
+    for scale in scales or [size]:
+        inp = imgs if scale == size else F.interpolate(imgs, size=(scale, scale), mode='bilinear',
+                                                        align_corners=False)
+        preds = model(inp)
+        coor = preds[..., :4] * (1.0 * size / scale)
+        if flip:
+            # x1,x2 of the flipped half swap and mirror
+            flipped = torch.stack([size - coor[bz:, :, 2], coor[bz:, :, 1],
+                                   size - coor[bz:, :, 0], coor[bz:, :, 3]], -1)
+            coor = torch.cat([coor[:bz], flipped], 0)
+            if boxloss == 'KL':
+                vari = preds[..., 4:8]
+                vari = torch.cat([vari[:bz], vari[bz:, :, [2, 1, 0, 3]]], 0)
+                preds = torch.cat([preds[..., :4], vari, preds[..., 8:]], -1)
+        preds = torch.cat([coor, preds[..., 4:]], -1)
+        outputs.extend(preds.split(bz, 0))
+    return torch.cat(outputs, 1)
+
+
+def merge_views(evalcfg, bboxes, variance=None):
+    """
+    :param bboxes: [bz,N,4+numcls] output of postprocess_boxes, the boxes of all views of tta_forward
+    :return: [(boxes,scores,labels)] for each image, by nms or weighted box fusion(EVAL.tta_merge)
+    """
+    if tta_enabled(evalcfg) and evalcfg.tta_merge == 'wbf':
+        return torch_wbf_batched(evalcfg, bboxes, tta_numviews(evalcfg))
+    return torch_nms_batched(evalcfg, bboxes, variance=variance)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    import models
+    from trainers import *
+    from yacscfg import _C as cfg
+    from utils.util import match_state_dict
+    from utils.ckpt_util import load_ckpt_file
+
+    parser = argparse.ArgumentParser(description="cost and mAP of test-time augmentation scale sets")
+    parser.add_argument("--config-file", default='configs/strongerv3.yaml')
+    parser.add_argument("--ckpt", default=None)
+    parser.add_argument("--scale-set", action='append', default=None,
+                        help="comma separated input sizes of a set, empty for test_size only, repeat for more sets")
+    parser.add_argument("--merge", default='nms,wbf', help="comma separated merge modes")
+    parser.add_argument("--valid-iter", type=int, default=-1, help="batches to evaluate, -1 for the whole set")
+    parser.add_argument("--device", default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("opts", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.MODEL.backbone_pretrained = ''
+    cfg.do_test = True
+
+    model = getattr(models, cfg.MODEL.modeltype)(cfg=cfg.MODEL)
+    if args.ckpt is not None:
+        state_dict = load_ckpt_file(args.ckpt)
+        state_dict = state_dict.get('state_dict', state_dict)
+        model.load_state_dict(match_state_dict(model.state_dict(), state_dict), strict=True)
+    model.to(args.device)
+    trainer = eval('Trainer_{}'.format(cfg.DATASET.dataset))(args=cfg, model=model, optimizer=None, lrscheduler=None)
+    trainer.device = torch.device(args.device)
+    baseline = None
+    for scales in args.scale_set or ['', '448,544,640']:
+        for flip in (False, True):
+            for merge in args.merge.split(',') if (scales or flip) else ['nms']:
+                cfg.EVAL.tta_scales = [int(s) for s in scales.split(',') if s]
+                cfg.EVAL.tta_flip = flip
+                cfg.EVAL.tta_merge = merge
+                start = time.time()
+                results = trainer._valid_epoch(validiter=args.valid_iter)[0]
+                elapsed = time.time() - start
+                trainer._reset_loggers()
+                baseline = baseline if baseline is not None else (results[0], elapsed)
+                print("scales:{} flip:{} merge:{} {}:{:.4f}({:+.4f}) time:{:.1f}s({:.2f}x)".format(
+                    cfg.EVAL.tta_scales or [cfg.EXPER.test_size], flip, merge, trainer.logger_custom[0], results[0],
+                    results[0] - baseline[0], elapsed, elapsed / baseline[1]))
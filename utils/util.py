@@ -3,6 +3,8 @@ import os
 from collections import OrderedDict
 import numpy as np
 import cv2
+import queue
+import threading
 import torch
 
 
@@ -103,6 +105,39 @@ def module2weight(moduledict):
     newdict.update({k.replace('module.', ''): v})
   return newdict
 
+def match_state_dict(model_state, state_dict, verbose=True):
+  """
+  Fit a checkpoint to a model in one pass over its keys: add or strip the 'module.' prefix of distributed models,
+  drop the keys the model does not have and keep the model's own weights for the missing or mis-shaped ones.
+  :param model_state: model.state_dict()
+  :param verbose: print the skipped keys
+  :return: state dict to load with strict=True
+  """
+  distributed = next(iter(model_state)).startswith('module.')
+  newdict = OrderedDict()
+  unexpected, misshaped = [], []
+  for k, v in state_dict.items():
+    if distributed and not k.startswith('module.'):
+      k = 'module.' + k
+    elif not distributed and k.startswith('module.'):
+      k = k[7:]
+    if k not in model_state:
+      unexpected.append(k)
+    elif v.shape != model_state[k].shape:
+      misshaped.append(k)
+    else:
+      newdict[k] = v
+  missing = [k for k in model_state if k not in newdict]
+  for k in missing:
+    newdict[k] = model_state[k]
+  if verbose:
+    if unexpected:
+      print("skipped {} checkpoint weights the model does not have: {}".format(len(unexpected), ', '.join(unexpected)))
+    if missing:
+      print("{} weights will be initialized from scratch({} of a different shape in the checkpoint): {}".format(
+        len(missing), len(misshaped), ', '.join(missing)))
+  return newdict
+
 class AverageMeter(object):
   """Computes and stores the average and current value"""
 
@@ -204,6 +239,45 @@ def pick_avail_port():
         if not is_port_used('127.0.0.1',port):
             return port
 
+
+class BackgroundWorker(object):
+    """
+    Calls fn(*args) for every submitted item on a background thread, in submission order.
+    submit blocks once maxsize items are pending, an exception raised by fn is raised again by submit or join.
+    """
+
+    def __init__(self, fn, maxsize=2, name=None):
+        self.fn = fn
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            # keep draining after a failure so submit never blocks forever
+            if self.error is None:
+                try:
+                    self.fn(*item)
+                except BaseException as e:
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, *args):
+        self._check()
+        self.queue.put(args)
+
+    def join(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
 # 测试
 if __name__ == '__main__':
     host_ip = get_host_ip()
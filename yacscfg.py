@@ -31,6 +31,22 @@ _C.EVAL.valid_epoch=15
 _C.EVAL.score_thres=0.1
 _C.EVAL.soft=False
 _C.EVAL.softsigma=False
+# number of batches waiting for postprocess/nms on the validation thread, 0 to run them inline
+_C.EVAL.pipeline_depth=2
+# test-time augmentation(see utils/tta_util.py): input sizes of the views, empty for test_size only
+_C.EVAL.tta_scales=[]
+# add the horizontally flipped image of each scale
+_C.EVAL.tta_flip=False
+# merge of the boxes of all views, 'nms' or 'wbf'(weighted box fusion)
+_C.EVAL.tta_merge='nms'
+# tiled inference of large images(Detector.detect_tiled): tile side in pixels, 0 for test_size
+_C.EVAL.tile_size=0
+# overlap of neighbouring tiles as a fraction of the tile side
+_C.EVAL.tile_overlap=0.2
+# tiles per forward
+_C.EVAL.tile_batch=8
+# also detect on the whole image letterboxed to test_size, for the objects larger than a tile
+_C.EVAL.tile_full=True
 
 _C.EXPER=CN()
 _C.EXPER.experiment_name=''
@@ -39,20 +55,47 @@ _C.EXPER.test_size=544
 _C.EXPER.resume=''
 _C.EXPER.US_training=False
 _C.EXPER.save_ckpt='best'
+# write the checkpoints on a background thread, training only waits while the previous one is being written
+_C.EXPER.ckpt_async=False
+# periodic checkpoints(checkpoint-<iter>.pth) kept on disk, 0 keeps all
+_C.EXPER.ckpt_keep=0
+# store the model weights of the checkpoints in fp16, the optimizer state stays fp32
+_C.EXPER.ckpt_half=False
 
 _C.OPTIM=CN()
 _C.OPTIM.batch_size=12
 _C.OPTIM.lr_initial=2e-4
 _C.OPTIM.total_epoch=60
 _C.OPTIM.milestones=[30,45]
+# bfloat16 autocast of the network in training and validation, decoding, target building and loss stay in fp32
+_C.OPTIM.amp=False
 
 _C.DATASET=CN()
 _C.DATASET.dataset= 'VOC'
 _C.DATASET.dataset_root='/home/gwl/datasets/VOCdevkit'
 _C.DATASET.numworker=4
+# DataLoader options, only used when numworker>0
+_C.DATASET.persistent_workers=False
+_C.DATASET.prefetch_factor=2
+# the dataloader returns uint8 images, the model scales them to [0,1] on its device(4x less ipc and copies)
+_C.DATASET.uint8=False
+# mixup partners come from a per-worker pool of this many augmented samples, 0 parses a second image
+_C.DATASET.mixup_pool=0
+# probability that a new sample replaces a random sample of the full pool
+_C.DATASET.mixup_refresh=0.25
 _C.DATASET.VOC_val='test'
+# build the yolo targets in dataloader workers, the loss only computes respond_bgd
+_C.DATASET.target_in_worker=False
+# directory of the decoded image cache(see dataset/image_cache.py), empty to read the raw images
+_C.DATASET.image_cache=''
+# directory of the parsed xml annotations(see utils/dataset_util.AnnotationIndex), empty to keep them in memory only
+_C.DATASET.anno_index=''
 _C.LOG=CN()
 _C.LOG.log_iter=200
+# time each phase of the training step, printed and written to tensorboard every log_iter iterations
+_C.LOG.profile=False
+# record a torch.profiler trace of this many training steps to the summary folder, 0 to disable
+_C.LOG.trace_steps=0
 
 _C.Prune=CN()
 _C.Prune.pruner=''